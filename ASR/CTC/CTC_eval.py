@@ -1,11 +1,12 @@
-from tensorflow.python.ops import ctc_ops as ctc
-# from tensorflow.contrib.ctc import ctc_ops as ctc   # depreciated in future
-import tensorflow as tf
 import numpy as np
-from utils import load_batched_data, target_list_to_sparse_tensor
-import pickle
-import sklearn.metrics as sk
+from utils import load_prepared_batches
 import gc
+# from Vision/, run from this directory as PYTHONPATH=../../Vision python CTC_eval.py
+import detection_metrics as dm
+import report
+
+# tensorflow is only imported to build and run the graph, so the scoring
+# helpers below can be imported without it
 
 ####Learning Parameters
 nEpochs = 60
@@ -16,163 +17,108 @@ nFeatures = 39      # MFCC coefficients, energy, delta, delta delta
 nHidden = 256
 nClasses = 40       # 40 because of 39 phones, plus the "blank" for CTC
 
-####Load data
-print('Loading data')
-data = pickle.load(open("TIMIT_data_prepared_for_CTC_clean.pkl", 'rb'), encoding='latin1')
-
-# 6300 x 776 x 39
-
-# we will the last 1300 examples from the 6300
-data_list = []
-for i in range(1300//batchSize):
-    offset = 5000 + batchSize * i
-    target_list = []
-    for j in range(batchSize):
-        target_list.append(data['y_phones'][offset+j])
-    data_list.append(
-        (data['x'][offset:offset+batchSize,:,:],
-         target_list_to_sparse_tensor(target_list),
-         data['mask'][offset:offset+batchSize]))
-
-del data
-
-batchedData, maxTimeSteps, totalN = data_list, 776, 13
-
-
-def clipped_gelu(x):
-    return tf.minimum(0.5 * x * (1 + tf.tanh(x)), 6)
-
-####Define graph
-print('Defining graph')
-graph = tf.Graph()
-with graph.as_default():
-
-    ####NOTE: try variable-steps inputs and dynamic bidirectional rnn, when it's implemented in tensorflow
-
-    ####Graph input
-    inputX = tf.placeholder(tf.float32, shape=(batchSize, maxTimeSteps, nFeatures))
-
-    #Prep input data to fit requirements of rnn.bidirectional_rnn
-    #  Reshape to 2-D tensor (nTimeSteps*batchSize, nfeatures)
-    inputXrs = tf.reshape(tf.transpose(inputX, [1, 0, 2]), [-1, nFeatures])
-    #  Split to get a list of 'n_steps' tensors of shape (batch_size, n_hidden)
-    inputList = tf.split(0, maxTimeSteps, inputXrs)
-    targetIxs = tf.placeholder(tf.int64)
-    targetVals = tf.placeholder(tf.int32)
-    targetShape = tf.placeholder(tf.int64)
-    targetY = tf.SparseTensor(targetIxs, targetVals, targetShape)
-    seqLengths = tf.placeholder(tf.int32, shape=(batchSize))
-    # print(inputX, targetIxs, targetVals, targetShape, seqLengths)
-
-    ####Weights & biases
-    weightsOutH1 = tf.Variable(tf.truncated_normal([2, nHidden],
-                                                   stddev=np.sqrt(2.0 / (2*nHidden))))
-    biasesOutH1 = tf.Variable(tf.zeros([nHidden]))
-    weightsOutH2 = tf.Variable(tf.truncated_normal([2, nHidden],
-                                                   stddev=np.sqrt(2.0 / (2*nHidden))))
-    biasesOutH2 = tf.Variable(tf.zeros([nHidden]))
-    weightsClasses = tf.Variable(tf.truncated_normal([nHidden, nClasses],
-                                                     stddev=np.sqrt(2.0 / nHidden)))
-    biasesClasses = tf.Variable(tf.zeros([nClasses]))
-
-    ####Network
-    lstm_cell = tf.nn.rnn_cell.LSTMCell(nHidden, state_is_tuple=True, activation=clipped_gelu)
-
-    cell_fw = tf.nn.rnn_cell.MultiRNNCell([lstm_cell] * 2, state_is_tuple=True)
-    cell_bw = tf.nn.rnn_cell.MultiRNNCell([lstm_cell] * 2, state_is_tuple=True)
-
-    fbH1, _, _ = tf.nn.bidirectional_rnn(cell_fw, cell_bw, inputList, dtype=tf.float32,
-                                         scope='BDLSTM_H1')
-    fbH1rs = [tf.reshape(t, [batchSize, 2, nHidden]) for t in fbH1]
-    outH1 = [tf.reduce_sum(tf.mul(t, weightsOutH1), reduction_indices=1) + biasesOutH1 for t in fbH1rs]
-
-    logits = [tf.matmul(t, weightsClasses) + biasesClasses for t in outH1]
-
-    ####Optimizing
-    logits3d = tf.pack(logits)
-    loss = tf.reduce_mean(ctc.ctc_loss(logits3d, targetY, seqLengths))
-
-    lr = tf.Variable(0.005, trainable=False)
-    tvars = tf.trainable_variables()
-    grads, _ = tf.clip_by_global_norm(tf.gradients(loss, tvars), 5)
-    opt = tf.train.RMSPropOptimizer(lr)
-    optimizer = opt.apply_gradients(zip(grads, tvars))
-
-    ####Evaluating
-    predictions = tf.to_int32(ctc.ctc_beam_search_decoder(logits3d, seqLengths)[0][0])
-    errorRate = tf.reduce_sum(tf.edit_distance(predictions, targetY, normalize=False)) / \
-                tf.to_float(tf.size(targetY.values))
-
-session = tf.InteractiveSession(graph=graph)
-tf.initialize_all_variables().run()
-saver = tf.train.Saver(max_to_keep=1)
-saver.restore(session, "./bdlstm-timit-clean.ckpt")
-print('Model Restored')
-
-kl_all = []
-pred_all = []
+maxTimeSteps = 776
 
-def softmax(x):
-    e_x = np.exp(x - np.max(x, axis=1, keepdims=True))
-    return e_x / np.sum(e_x, axis=1, keepdims=True)
 
-batchErrors = np.zeros(len(batchedData))
-batchRandIxs = np.random.permutation(len(batchedData))      # randomize batch order
-for batch, batchOrigI in enumerate(batchRandIxs):
-    batchInputs, batchTargetSparse, batchSeqLengths = batchedData[batchOrigI]
-    batchTargetIxs, batchTargetVals, batchTargetShape = batchTargetSparse
-    feedDict = {inputX: batchInputs, targetIxs: batchTargetIxs, targetVals: batchTargetVals.tolist(),
-                targetShape: batchTargetShape, seqLengths: batchSeqLengths}
-    er, preds = session.run([errorRate, logits3d], feed_dict=feedDict)
+def build_graph():
+    '''the BDLSTM trained by bdlstm_train.py; returns the graph and the tensors
+       (inputX, targetIxs, targetVals, targetShape, seqLengths, logits3d, errorRate)'''
+    from tensorflow.python.ops import ctc_ops as ctc
+    # from tensorflow.contrib.ctc import ctc_ops as ctc   # depreciated in future
+    import tensorflow as tf
 
-    for i in range(preds.shape[1]):
-        preds_cut_by_time = preds[:int(batchSeqLengths[i]), i, :]
-        # remove example where blank is predicted
-        s_pred_blanks_removed = softmax(preds_cut_by_time[:,:39])
+    def clipped_gelu(x):
+        return tf.minimum(0.5 * x * (1 + tf.tanh(x)), 6)
 
-        kl = np.mean(np.log(nFeatures-1) + np.sum(s_pred_blanks_removed * np.log(s_pred_blanks_removed + 1e-11), axis=1))
+    graph = tf.Graph()
+    with graph.as_default():
 
-        kl_all.append(kl)
-        pred_all.append(np.mean(np.max(s_pred_blanks_removed, axis=1)))
+        ####NOTE: try variable-steps inputs and dynamic bidirectional rnn, when it's implemented in tensorflow
 
-    batchErrors[batch] = er*len(batchSeqLengths)
-epochErrorRate = batchErrors.sum() / len(batchedData)
+        ####Graph input
+        inputX = tf.placeholder(tf.float32, shape=(batchSize, maxTimeSteps, nFeatures))
 
-print('Edit distance', epochErrorRate, 'Softmax Confidence (mean, std)', np.mean(pred_all), np.std(pred_all))
+        #Prep input data to fit requirements of rnn.bidirectional_rnn
+        #  Reshape to 2-D tensor (nTimeSteps*batchSize, nfeatures)
+        inputXrs = tf.reshape(tf.transpose(inputX, [1, 0, 2]), [-1, nFeatures])
+        #  Split to get a list of 'n_steps' tensors of shape (batch_size, n_hidden)
+        inputList = tf.split(0, maxTimeSteps, inputXrs)
+        targetIxs = tf.placeholder(tf.int64)
+        targetVals = tf.placeholder(tf.int32)
+        targetShape = tf.placeholder(tf.int64)
+        targetY = tf.SparseTensor(targetIxs, targetVals, targetShape)
+        seqLengths = tf.placeholder(tf.int32, shape=(batchSize))
+        # print(inputX, targetIxs, targetVals, targetShape, seqLengths)
 
-del data_list; del batchedData; del batch   # save memory
+        ####Weights & biases
+        weightsOutH1 = tf.Variable(tf.truncated_normal([2, nHidden],
+                                                       stddev=np.sqrt(2.0 / (2*nHidden))))
+        biasesOutH1 = tf.Variable(tf.zeros([nHidden]))
+        weightsOutH2 = tf.Variable(tf.truncated_normal([2, nHidden],
+                                                       stddev=np.sqrt(2.0 / (2*nHidden))))
+        biasesOutH2 = tf.Variable(tf.zeros([nHidden]))
+        weightsClasses = tf.Variable(tf.truncated_normal([nHidden, nClasses],
+                                                         stddev=np.sqrt(2.0 / nHidden)))
+        biasesClasses = tf.Variable(tf.zeros([nClasses]))
 
-gc.collect()
+        ####Network
+        lstm_cell = tf.nn.rnn_cell.LSTMCell(nHidden, state_is_tuple=True, activation=clipped_gelu)
 
-for oos_name in ['airport', 'babble', 'car', 'exhibition', 'restaurant', 'street', 'subway', 'train']:
-    print('Loading OOD data')
-    data = pickle.load(open("TIMIT_data_prepared_for_CTC_" + oos_name + ".pkl", 'rb'), encoding='latin1')
+        cell_fw = tf.nn.rnn_cell.MultiRNNCell([lstm_cell] * 2, state_is_tuple=True)
+        cell_bw = tf.nn.rnn_cell.MultiRNNCell([lstm_cell] * 2, state_is_tuple=True)
 
-    # 6300 x 776 x 39
+        fbH1, _, _ = tf.nn.bidirectional_rnn(cell_fw, cell_bw, inputList, dtype=tf.float32,
+                                             scope='BDLSTM_H1')
+        fbH1rs = [tf.reshape(t, [batchSize, 2, nHidden]) for t in fbH1]
+        outH1 = [tf.reduce_sum(tf.mul(t, weightsOutH1), reduction_indices=1) + biasesOutH1 for t in fbH1rs]
 
-    # we will the last 1300 examples from the 6300
-    data_list = []
-    for i in range(1300//batchSize):
-        offset = 5000 + batchSize * i
-        target_list = []
-        for j in range(batchSize):
-            target_list.append(data['y_phones'][offset+j])
-        data_list.append(
-            (data['x'][offset:offset+batchSize,:,:],
-             target_list_to_sparse_tensor(target_list),
-             data['mask'][offset:offset+batchSize]))
+        logits = [tf.matmul(t, weightsClasses) + biasesClasses for t in outH1]
+
+        ####Optimizing
+        logits3d = tf.pack(logits)
+        loss = tf.reduce_mean(ctc.ctc_loss(logits3d, targetY, seqLengths))
+
+        lr = tf.Variable(0.005, trainable=False)
+        tvars = tf.trainable_variables()
+        grads, _ = tf.clip_by_global_norm(tf.gradients(loss, tvars), 5)
+        opt = tf.train.RMSPropOptimizer(lr)
+        optimizer = opt.apply_gradients(zip(grads, tvars))
 
-    del data
+        ####Evaluating
+        predictions = tf.to_int32(ctc.ctc_beam_search_decoder(logits3d, seqLengths)[0][0])
+        errorRate = tf.reduce_sum(tf.edit_distance(predictions, targetY, normalize=False)) / \
+                    tf.to_float(tf.size(targetY.values))
 
-    batchedData, maxTimeSteps, totalN = data_list, 776, 13
+    return graph, (inputX, targetIxs, targetVals, targetShape, seqLengths, logits3d, errorRate)
 
-    kl_ood = []
-    pred_ood = []
 
-    def softmax(x):
-        e_x = np.exp(x - np.max(x, axis=1, keepdims=True))
-        return e_x / np.sum(e_x, axis=1, keepdims=True)
+def softmax(x):
+    e_x = np.exp(x - np.max(x, axis=1, keepdims=True))
+    return e_x / np.sum(e_x, axis=1, keepdims=True)
+
+
+def utterance_scores(preds, batchSeqLengths):
+    '''KL[p||u] and mean prediction probability of every utterance of a batch
+       of (time, batch, class) network outputs'''
+    kl_batch, pred_batch = [], []
+    for i in range(preds.shape[1]):
+        preds_cut_by_time = preds[:int(batchSeqLengths[i]), i, :]
+        # remove example where blank is predicted
+        s_pred_blanks_removed = softmax(preds_cut_by_time[:,:39])
+
+        kl = np.mean(np.log(nFeatures-1) + np.sum(s_pred_blanks_removed * np.log(s_pred_blanks_removed + 1e-11), axis=1))
 
+        kl_batch.append(kl)
+        pred_batch.append(np.mean(np.max(s_pred_blanks_removed, axis=1)))
+    return kl_batch, pred_batch
+
+
+def score_batches(session, tensors, batchedData):
+    '''runs the network on every batch; returns the edit distance and the
+       KL[p||u] and prediction probability of every utterance'''
+    inputX, targetIxs, targetVals, targetShape, seqLengths, logits3d, errorRate = tensors
+    kl_all = []
+    pred_all = []
     batchErrors = np.zeros(len(batchedData))
     batchRandIxs = np.random.permutation(len(batchedData))      # randomize batch order
     for batch, batchOrigI in enumerate(batchRandIxs):
@@ -182,36 +128,65 @@ for oos_name in ['airport', 'babble', 'car', 'exhibition', 'restaurant', 'street
                     targetShape: batchTargetShape, seqLengths: batchSeqLengths}
         er, preds = session.run([errorRate, logits3d], feed_dict=feedDict)
 
-        for i in range(preds.shape[1]):
-            preds_cut_by_time = preds[:int(batchSeqLengths[i]), i, :]
-            # remove example where blank is predicted
-            s_pred_blanks_removed = softmax(preds_cut_by_time[:,:39])
+        kl_batch, pred_batch = utterance_scores(preds, batchSeqLengths)
+        kl_all.extend(kl_batch)
+        pred_all.extend(pred_batch)
+
+        batchErrors[batch] = er*len(batchSeqLengths)
+    return batchErrors.sum() / len(batchedData), kl_all, pred_all
 
-            kl = np.mean(np.log(nFeatures-1) + np.sum(s_pred_blanks_removed * np.log(s_pred_blanks_removed + 1e-11), axis=1))
 
-            kl_ood.append(kl)
-            pred_ood.append(np.mean(np.max(s_pred_blanks_removed, axis=1)))
+if __name__ == '__main__':
+    import tensorflow as tf
+
+    ####Load data
+    print('Loading data')
+    # we will the last 1300 examples from the 6300
+    batchedData = load_prepared_batches("TIMIT_data_prepared_for_CTC_clean.pkl", 5000, 1300, batchSize)
+
+    ####Define graph
+    print('Defining graph')
+    graph, tensors = build_graph()
+
+    session = tf.InteractiveSession(graph=graph)
+    tf.initialize_all_variables().run()
+    saver = tf.train.Saver(max_to_keep=1)
+    saver.restore(session, "./bdlstm-timit-clean.ckpt")
+    print('Model Restored')
+
+    epochErrorRate, kl_all, pred_all = score_batches(session, tensors, batchedData)
+
+    print('Edit distance', epochErrorRate, 'Softmax Confidence (mean, std)', np.mean(pred_all), np.std(pred_all))
+
+    del batchedData   # save memory
+
+    # the in-distribution scores are sorted once and reused for every noise type
+    kl_all, pred_all = dm.sort_scores(kl_all), dm.sort_scores(pred_all)
 
-        batchErrors[batch] = er*len(batchSeqLengths)
-    epochErrorRate = batchErrors.sum() / len(batchedData)
-
-    print(oos_name, 'edit distance', epochErrorRate, 'Softmax Confidence (mean, std)', np.mean(pred_ood), np.std(pred_ood))
-
-    print('\n' + oos_name, 'KL[p||u]: In/out distribution distinction')
-    in_sample, oos = kl_all, kl_ood
-    labels = np.zeros((len(in_sample) + len(oos)), dtype=np.int32)
-    labels[:len(in_sample)] += 1
-    examples = np.squeeze(np.vstack((np.array(in_sample).reshape((-1,1)), np.array(oos).reshape((-1,1)))))
-    print('AUPR', sk.average_precision_score(labels, examples))
-    print('AUROC', sk.roc_auc_score(labels, examples))
-
-    print('\n' + oos_name, 'Prediction Prob: In/out distribution distinction')
-    in_sample, oos = pred_all, pred_ood
-    labels = np.zeros((len(in_sample) + len(oos)), dtype=np.int32)
-    labels[:len(in_sample)] += 1
-    examples = np.squeeze(np.vstack((np.array(in_sample).reshape((-1,1)), np.array(oos).reshape((-1,1)))))
-    print('AUPR', sk.average_precision_score(labels, examples))
-    print('AUROC', sk.roc_auc_score(labels, examples))
-
-    del data_list; del batchedData; del batch   # save memory; it's possible that this doesn't work at all
     gc.collect()
+
+    # every score is also saved, so the measures can be recomputed without tensorflow:
+    #   python ../../Vision/report.py scores ctc_scores.npz
+    ood_scores = {}
+
+    for oos_name in ['airport', 'babble', 'car', 'exhibition', 'restaurant', 'street', 'subway', 'train']:
+        print('Loading OOD data')
+        # we will the last 1300 examples from the 6300
+        batchedData = load_prepared_batches("TIMIT_data_prepared_for_CTC_" + oos_name + ".pkl", 5000, 1300, batchSize)
+
+        epochErrorRate, kl_ood, pred_ood = score_batches(session, tensors, batchedData)
+
+        print(oos_name, 'edit distance', epochErrorRate, 'Softmax Confidence (mean, std)', np.mean(pred_ood), np.std(pred_ood))
+
+        print('\n' + oos_name, 'KL[p||u]: In/out distribution distinction')
+        dm.print_measures(dm.get_measures(kl_all, kl_ood))
+
+        print('\n' + oos_name, 'Prediction Prob: In/out distribution distinction')
+        dm.print_measures(dm.get_measures(pred_all, pred_ood))
+
+        ood_scores[oos_name] = {'KL[p||u]': kl_ood, 'Prediction Prob': pred_ood}
+
+        del batchedData   # save memory; it's possible that this doesn't work at all
+        gc.collect()
+
+    report.save_scores('ctc_scores.npz', {'KL[p||u]': kl_all, 'Prediction Prob': pred_all}, ood_scores)
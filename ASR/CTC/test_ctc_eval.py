@@ -0,0 +1,26 @@
+# the scoring helpers of the CTC scripts must import without tensorflow: import
+# them in a fresh interpreter and check what was imported
+
+import os
+import sys
+import json
+import subprocess
+
+CTC = os.path.dirname(os.path.abspath(__file__))
+
+SCRIPT = '''
+import sys, json
+import numpy as np
+import CTC_eval, bdlstm_train
+preds = np.random.RandomState(0).randn(20, 3, 40)
+kl, prob = CTC_eval.utterance_scores(preds, [20, 10, 5])
+assert len(kl) == len(prob) == 3
+print(json.dumps('tensorflow' in sys.modules))
+'''
+
+
+def test_ctc_scripts_import_without_tensorflow():
+    env = dict(os.environ, PYTHONPATH=os.path.join(CTC, '..', '..', 'Vision'))
+    out = subprocess.run([sys.executable, '-c', SCRIPT], cwd=CTC, env=env, check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True).stdout
+    assert json.loads(out.strip().splitlines()[-1]) is False
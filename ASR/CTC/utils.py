@@ -1,5 +1,5 @@
+import pickle
 import numpy as np
-import tensorflow as tf
 
 def target_list_to_sparse_tensor(targetList):
     '''make tensorflow SparseTensor from list of targets, with each element
@@ -17,6 +17,7 @@ def target_list_to_sparse_tensor(targetList):
     return (np.array(indices), np.array(vals), np.array(shape))
 
 def test_edit_distance():
+    import tensorflow as tf
     graph = tf.Graph()
     with graph.as_default():
         truth = tf.sparse_placeholder(tf.int32)
@@ -78,3 +79,20 @@ def load_batched_data(specPath, targetPath, batchSize):
                                  [np.load(os.path.join(targetPath, fn)) for fn in os.listdir(targetPath)],
                                  batchSize) + \
             (len(os.listdir(specPath)),)
+
+def load_prepared_batches(fname, offset, n, batchSize):
+    '''batches of n utterances of a prepared TIMIT pickle (6300 x 776 x 39),
+       from utterance offset on; each batch is a 3-element tuple of inputs,
+       targets as required for a SparseTensor, and masks'''
+    data = pickle.load(open(fname, 'rb'), encoding='latin1')
+    data_list = []
+    for i in range(n//batchSize):
+        start = offset + batchSize * i
+        target_list = []
+        for j in range(batchSize):
+            target_list.append(data['y_phones'][start+j])
+        data_list.append(
+            (data['x'][start:start+batchSize,:,:],
+             target_list_to_sparse_tensor(target_list),
+             data['mask'][start:start+batchSize]))
+    return data_list
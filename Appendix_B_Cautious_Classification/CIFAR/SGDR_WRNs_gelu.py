@@ -10,6 +10,7 @@ https://gist.github.com/FlorianMuellerklein/3d9ba175038a3f2e7de3794fa303f1ee
 import sys
 import os
 import time
+import json
 import string
 import random
 import pickle
@@ -20,6 +21,14 @@ import theano.tensor as T
 import lasagne
 import math
 
+# shared with Vision/, see the usage note at the bottom
+import cifar_cache
+import calibration
+import logits_cache as lc
+import minibatch_pipeline as mbp
+import checkpoint_writer as cw
+import training_stats as ts
+
 from lasagne.nonlinearities import rectify, softmax
 from lasagne.layers import InputLayer, DenseLayer, DropoutLayer, batch_norm
 try:
@@ -41,63 +50,15 @@ sys.setrecursionlimit(10000)
 # from 'https://www.cs.toronto.edu/~kriz/cifar-10-python.tar.gz' for CIFAR-10
 # from 'https://www.cs.toronto.edu/~kriz/cifar-100-python.tar.gz' for CIFAR-100
 
-def unpickle(file):
-    import pickle
-    fo = open(file, 'rb')
-    dict = pickle.load(fo, encoding='latin1')
-    fo.close()
-    return dict
-
 def load_data(dataset):
-    xs = []
-    ys = []
-    if dataset == 'CIFAR-10':
-        for j in range(5):
-          d = unpickle('/home-nfs/dan/cifar_data/cifar-10-batches-py/data_batch_'+str(j+1))
-          x = d['data']
-          y = d['labels']
-          xs.append(x)
-          ys.append(y)
-
-        d = unpickle('/home-nfs/dan/cifar_data/cifar-10-batches-py/test_batch')
-        xs.append(d['data'])
-        ys.append(d['labels'])
-    if dataset == 'CIFAR-100':
-        d = unpickle('/home-nfs/dan/cifar_data/cifar-100-python/train')
-        x = d['data']
-        y = d['fine_labels']
-        xs.append(x)
-        ys.append(y)
-
-        d = unpickle('/home-nfs/dan/cifar_data/cifar-100-python/test')
-        xs.append(d['data'])
-        ys.append(d['fine_labels'])
-
-    x = np.concatenate(xs)/np.float32(255)
-    y = np.concatenate(ys)
-    x = np.dstack((x[:, :1024], x[:, 1024:2048], x[:, 2048:]))
-    x = x.reshape((x.shape[0], 32, 32, 3)).transpose(0,3,1,2)
-
-    # subtract per-pixel mean
-    pixel_mean = np.mean(x[0:50000],axis=0)
-    x -= pixel_mean
-
-    # create mirrored images
-    X_train = x[0:50000,:,:,:]
-    Y_train = y[0:50000]
-    X_train_flip = X_train[:,:,:,::-1]
-    Y_train_flip = Y_train
-    X_train = np.concatenate((X_train,X_train_flip),axis=0)
-    Y_train = np.concatenate((Y_train,Y_train_flip),axis=0)
-
-    X_test = x[50000:,:,:,:]
-    Y_test = y[50000:]
-
+    # the normalized arrays are built once by cifar_cache.build_cache and
+    # memory-mapped on every later run; mirrored images are made on the fly
+    data = cifar_cache.load_cached(dataset, data_dir='/home-nfs/dan/cifar_data')
     return dict(
-        X_train=lasagne.utils.floatX(X_train),
-        Y_train=Y_train.astype('int32'),
-        X_test=lasagne.utils.floatX(X_test),
-        Y_test=Y_test.astype('int32'),)
+        X_train=lasagne.utils.floatX(data['X_train']),
+        Y_train=data['Y_train'],
+        X_test=lasagne.utils.floatX(data['X_test']),
+        Y_test=data['Y_test'],)
 
 # ##################### Build the neural network model #######################
 
@@ -190,7 +151,9 @@ def ResNet_FullPre_Wide(input_var=None, nout=10,  n=3, k=2, dropoutrate = 0):
 
 # ############################# Batch iterator ###############################
 
-def iterate_minibatches(inputs, targets, batchsize, shuffle=False, augment=False):
+# the randomly cropped training minibatches come from mbp.AugmentedBatches
+
+def iterate_minibatches(inputs, targets, batchsize, shuffle=False):
     assert len(inputs) == len(targets)
     if shuffle:
         indices = np.arange(len(inputs))
@@ -200,36 +163,53 @@ def iterate_minibatches(inputs, targets, batchsize, shuffle=False, augment=False
             excerpt = indices[start_idx:start_idx + batchsize]
         else:
             excerpt = slice(start_idx, start_idx + batchsize)
-        if augment:
-            # as in paper :
-            # pad feature arrays with 4 pixels on each side
-            # and do random cropping of 32x32
-            padded = np.pad(inputs[excerpt],((0,0),(0,0),(4,4),(4,4)),mode='constant')
-            random_cropped = np.zeros(inputs[excerpt].shape, dtype=np.float32)
-            crops = np.random.random_integers(0,high=8,size=(batchsize,2))
-            for r in range(batchsize):
-                random_cropped[r,:,:,:] = padded[r,:,crops[r,0]:(crops[r,0]+32),crops[r,1]:(crops[r,1]+32)]
-            inp_exc = random_cropped
-        else:
-            inp_exc = inputs[excerpt]
-
-        yield inp_exc, targets[excerpt]
+        yield inputs[excerpt], targets[excerpt]
+
+# ############################## Training state ##############################
+
+def training_state(params, velocities, sh_lr, train_order, meta):
+    # everything needed to continue training exactly where it stopped, as a
+    # dict of arrays for CheckpointWriter.save; meta holds the JSON
+    # serializable scalars
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {'param_%d' % i: p.get_value(borrow=True) for i, p in enumerate(params)}
+    state.update(('velocity_%d' % i, v.get_value(borrow=True)) for i, v in enumerate(velocities))
+    state.update(lr=sh_lr.get_value(), train_order=train_order, np_random_keys=keys,
+                 meta=np.array(json.dumps(dict(meta, np_random=[name, pos, has_gauss, cached_gaussian]))))
+    return state
+
+
+def load_training_state(fname):
+    # returns (arrays, meta) as saved by training_state
+    with np.load(fname) as f:
+        state = {key: f[key] for key in f.files}
+    meta = json.loads(str(state.pop('meta')))
+    name, pos, has_gauss, cached_gaussian = meta.pop('np_random')
+    meta['np_random'] = (name, state.pop('np_random_keys'), pos, has_gauss, cached_gaussian)
+    return state, meta
 
 # ############################## Main program ################################
 
 def main(mode="softmax", dataset = 'CIFAR-10', iscenario = 0, n=5, k = 1, num_epochs=82, model = None, irun = 0, Te = 2.0, E1 = 41, E2 = 61, E3 = 81,
-         lr=0.1, lr_fac=0.1, reg_fac=0.0005, t0=math.pi/2.0, Estart = 0, dropoutrate = 0, multFactor = 1):
+         lr=0.1, lr_fac=0.1, reg_fac=0.0005, t0=math.pi/2.0, Estart = 0, dropoutrate = 0, multFactor = 1,
+         keep_last = None, keep_best = None, keep_every = None, prune_ensemble = False, resume = False, profiler = None):
 
     # modes: "softmax" and "sigmoid"
+    # keep_*: retention rules for the saved checkpoints, see checkpoint_writer;
+    #         with none of them given every checkpoint is kept
+    # prune_ensemble: let the rules also prune the checkpoints of epochs 40-49,
+    #         which CIFAR_Detection.py scores as a snapshot ensemble
+    # resume: continue training from the state saved after the last finished epoch
+    # profiler: e.g. ts.StackSampler(), started and stopped around every epoch
 
     # Check if CIFAR data exists
     if dataset == 'CIFAR-10':
-        if not os.path.exists("/home-nfs/dan/cifar_data/cifar-10-batches-py/"):
+        if not cifar_cache.has_data(dataset, data_dir='/home-nfs/dan/cifar_data'):
             print("CIFAR-10 dataset can not be found. Please download the dataset from 'https://www.cs.toronto.edu/~kriz/cifar.html'.")
             return
         nout = 10
     if dataset == 'CIFAR-100':
-        if not os.path.exists("/home-nfs/dan/cifar_data/cifar-100-python/"):
+        if not cifar_cache.has_data(dataset, data_dir='/home-nfs/dan/cifar_data'):
             print("CIFAR-100 dataset can not be found. Please download the dataset from 'https://www.cs.toronto.edu/~kriz/cifar.html'.")
             return
         nout = 100
@@ -300,44 +280,106 @@ def main(mode="softmax", dataset = 'CIFAR-10', iscenario = 0, n=5, k = 1, num_ep
     # Compile a second function computing the validation loss and accuracy:
     val_fn = theano.function([input_var, target_var], [test_loss, test_acc, test_calibration, test_model_score])
 
+    # the training state is saved after every epoch
+    resume_file = "./data/resume_{}_{}.npz".format(iscenario, irun)
+    state = None
+    if resume and model is None:
+        if os.path.exists(resume_file):
+            state, meta = load_training_state(resume_file)
+        else:
+            print("No training state in {}, starting from scratch.".format(resume_file))
+
     # statistics file
     filename = "stat_{}_{}.txt".format(iscenario, irun)
-    myfile = open(filename, 'w+')
-    start_time0 = time.time()
+    # throughput and time per stage of every epoch, one JSON object per line
+    perf_filename = "stat_{}_{}.jsonl".format(iscenario, irun)
+    if state is not None:
+        # the rows of the epochs after the saved state, written before the
+        # run was interrupted, are written again
+        ts.keep_first_lines(filename, meta['epoch'])
+        ts.keep_first_lines(perf_filename, meta['epoch'])
+    myfile = open(filename, 'w+' if state is None else 'a')
+    start_time0 = time.time() - (0 if state is None else meta['elapsed'])
+    perf_log = ts.StatsLog(perf_filename, append=state is not None)
+    timer = ts.StageTimer()
 
     tt = 0
     TeNext = Te
     batchsize = 128
 
+    # as in paper: pad with 4 pixels on each side and do random cropping of
+    # 32x32, in background threads while train_fn runs; an epoch sees every
+    # image as is and mirrored
+    augmenter = mbp.AugmentedBatches(batchsize, X_train.shape[1:], X_train.dtype, pad=4, flip=True,
+                                     n_workers=2, seed=irun)
+
     if model is None:
-        # launch the training loop
-        print("Starting training...")
+        # checkpoints are written by a background thread, and pruned if asked to
+        ensemble = [] if prune_ensemble else ["./data/network_{}_{}_4[0-9].npz".format(iscenario, irun)]
+        writer = cw.CheckpointWriter(keep_last=keep_last, keep_best=keep_best, keep_every=keep_every,
+                                     keep_patterns=ensemble,
+                                     saved=None if state is None else meta['checkpoints'])
+        params_to_save = lasagne.layers.get_all_params(network)
+        # the Nesterov velocities are the variables updated besides the parameters
+        trainable = set(params)
+        velocities = [v for v in updates if v not in trainable]
+        # X_train[i] is row train_order[i] of the cached training set
+        train_order = np.arange(len(Y_train))
+        start_epoch = 0
+
+        if state is not None:
+            lasagne.layers.set_all_param_values(network, [state['param_%d' % i] for i in range(len(params_to_save))])
+            for i, v in enumerate(velocities):
+                v.set_value(state['velocity_%d' % i])
+            sh_lr.set_value(state['lr'])
+            train_order = state['train_order']
+            X_train = X_train[train_order,:,:,:]
+            Y_train = Y_train[train_order]
+            tt, TeNext, Te = meta['tt'], meta['TeNext'], meta['Te']
+            np.random.set_state(meta['np_random'])
+            augmenter.set_state(meta['augmenter'])
+            start_epoch = meta['epoch']
+            print("Resuming training at epoch {}...".format(start_epoch + 1))
+        else:
+            # launch the training loop
+            print("Starting training...")
+
         # We iterate over epochs:
-        for epoch in range(num_epochs):
+        for epoch in range(start_epoch, num_epochs):
+            epoch_start = time.time()
+            write_seconds = writer.write_seconds
+            if profiler is not None:
+                profiler.start()
+
             # shuffle training data
-            train_indices = np.arange(X_train.shape[0])
-            np.random.shuffle(train_indices)
-            X_train = X_train[train_indices,:,:,:]
-            Y_train = Y_train[train_indices]
+            with timer('data'):
+                train_indices = np.arange(X_train.shape[0])
+                np.random.shuffle(train_indices)
+                X_train = X_train[train_indices,:,:,:]
+                Y_train = Y_train[train_indices]
+                train_order = train_order[train_indices]
 
             # In each epoch, we do a full pass over the training data:
             train_err = 0
             train_batches = 0
             start_time = time.time()
 
-            for batch in iterate_minibatches(X_train, Y_train, batchsize, shuffle=True, augment=True):
+            # 'data' is the time spent waiting for the augmentation workers
+            for batch in timer.iterate(augmenter.iterate(X_train, Y_train, shuffle=True), 'data'):
                 inputs, targets = batch
-                train_err += train_fn(inputs, targets)
+                with timer('train_fn'):
+                    train_err += train_fn(inputs, targets)
                 train_batches += 1
 
                 if (epoch+1 >= Estart): # time to start adjust learning tate
                     dt = 2.0*math.pi/float(2.0*Te)
-                    tt = tt + float(dt)/(len(Y_train)/float(batchsize))
+                    tt = tt + float(dt)/(augmenter.epoch_size(len(Y_train))/float(batchsize))
                     if tt >= math.pi:
                         tt = tt - math.pi
                     curT = t0 + tt
                     new_lr = lr * (1.0 + math.sin(curT))/2.0    # lr_min = 0, lr_max = lr
                     sh_lr.set_value(lasagne.utils.floatX(new_lr))
+            train_time = time.time() - start_time
 
             if epoch+1 == TeNext:     # time to restart TODO: remove second condition
                 tt = 0                  # by setting to 0 we set lr to lr_max, see above
@@ -350,17 +392,20 @@ def main(mode="softmax", dataset = 'CIFAR-10', iscenario = 0, n=5, k = 1, num_ep
             val_align = 0
             val_model_score = 0
             val_batches = 0
-            for batch in iterate_minibatches(X_test, Y_test, 500, shuffle=False):
-                inputs, targets = batch
-                err, acc, align, score = val_fn(inputs, targets)
-                val_err += err
-                val_acc += acc
-                val_align += align
-                val_model_score += score
-                val_batches += 1
+            with timer('validation'):
+                for batch in iterate_minibatches(X_test, Y_test, 500, shuffle=False):
+                    inputs, targets = batch
+                    err, acc, align, score = val_fn(inputs, targets)
+                    val_err += err
+                    val_acc += acc
+                    val_align += align
+                    val_model_score += score
+                    val_batches += 1
 
             # Then we print the results for this epoch:
             print("Epoch {} of {} took {:.3f}s".format(epoch + 1, num_epochs, time.time() - start_time))
+            print("  images/sec:\t\t{:.1f} (data {:.1f}s, train_fn {:.1f}s, validation {:.1f}s)".format(
+                train_batches * batchsize / train_time, timer.totals['data'], timer.totals['train_fn'], timer.totals['validation']))
             print("  training loss:\t\t{:.6f}".format(train_err / train_batches))
             print("  validation loss:\t\t{:.6f}".format(val_err / val_batches))
             print("  validation accuracy:\t\t{:.2f} %".format(val_acc / val_batches * 100))
@@ -374,7 +419,8 @@ def main(mode="softmax", dataset = 'CIFAR-10', iscenario = 0, n=5, k = 1, num_ep
             # dump the network weights to a file :
             if epoch % 10 == 0 or epoch > 48:
                 filesave = "./data/network_{}_{}_{}.npz".format(iscenario,irun,epoch)
-                np.savez(filesave, *lasagne.layers.get_all_param_values(network))
+                with timer('checkpoint'):
+                    writer.save(filesave, [p.get_value(borrow=True) for p in params_to_save], epoch, val_acc / val_batches)
                 # pickle.dump(lasagne.layers.get_all_param_values(network),
                 #             open("./data/network_{}_{}_{}.pkl".format(iscenario,irun,epoch), 'wb'))
                 print('Saved')
@@ -385,9 +431,32 @@ def main(mode="softmax", dataset = 'CIFAR-10', iscenario = 0, n=5, k = 1, num_ep
                 print("New LR:"+str(new_lr))
                 sh_lr.set_value(lasagne.utils.floatX(new_lr))
 
+            # everything needed to go on from the next epoch
+            with timer('checkpoint'):
+                writer.save(resume_file, training_state(params_to_save, velocities, sh_lr, train_order, {
+                    'epoch': epoch + 1, 'tt': tt, 'TeNext': TeNext, 'Te': Te, 'elapsed': time.time() - start_time0,
+                    'augmenter': augmenter.get_state(), 'checkpoints': writer.saved}))
+
+            # checkpoint: time the training thread spent snapshotting;
+            # checkpoint_write: time the writer thread spent on disk meanwhile
+            stages = timer.reset()
+            record = {'epoch': epoch, 'images': train_batches * batchsize,
+                      'images_per_sec': train_batches * batchsize / train_time,
+                      'epoch_seconds': time.time() - epoch_start, 'train_seconds': train_time,
+                      'data_seconds': stages['data'], 'train_fn_seconds': stages['train_fn'],
+                      'validation_seconds': stages['validation'], 'checkpoint_seconds': stages['checkpoint'],
+                      'checkpoint_write_seconds': writer.write_seconds - write_seconds,
+                      'peak_rss_mb': ts.peak_rss_mb(), 'lr': float(sh_lr.get_value()),
+                      'train_loss': float(train_err / train_batches), 'val_loss': float(val_err / val_batches),
+                      'val_acc': float(val_acc / val_batches)}
+            if profiler is not None:
+                record['profile'] = profiler.stop()
+            perf_log.write(record)
+
         # final save
         filesave = "./data/network_{}_{}_end.npz".format(iscenario,irun)
-        np.savez(filesave, *lasagne.layers.get_all_param_values(network))
+        writer.save(filesave, [p.get_value(borrow=True) for p in params_to_save])
+        writer.close()
         # pickle.dump(lasagne.layers.get_all_param_values(network),
         #             open("./data/network_{}_{}_end.pkl".format(iscenario,irun), 'wb'))
 
@@ -398,6 +467,7 @@ def main(mode="softmax", dataset = 'CIFAR-10', iscenario = 0, n=5, k = 1, num_ep
         lasagne.layers.set_all_param_values(network, param_values)
 
     myfile.close()
+    perf_log.close()
 
     # Calculate validation error of model:
     val_err = 0
@@ -418,15 +488,36 @@ def main(mode="softmax", dataset = 'CIFAR-10', iscenario = 0, n=5, k = 1, num_ep
     print("Test calibration:\t\t{:.2f} %".format(val_align / val_batches * 100))
     print("Test model score:\t\t{:.2f} %".format(val_model_score / val_batches * 100))
 
+    # ECE/MCE and temperature scaling from the (cached) test logits
+    checkpoint = model if model is not None else filesave
+    logits_fn = theano.function([input_var], lasagne.layers.get_output(network.input_layer, deterministic=True))
+    test_logits = lc.get_logits(logits_fn, checkpoint, X_test)
+    calibration.print_calibration(test_logits, Y_test)
+
 
 if __name__ == '__main__':
 
+    # run from this directory with Vision/ on the path, e.g.
+    #   PYTHONPATH=../../Vision python SGDR_WRNs_gelu.py 13
     # the only input is 'iscenario' index used to reproduce the experiments given in the paper
     # scenario #1 and #2 correspond to the original multi-step learning rate decay on CIFAR-10
     # scenarios [3-6] are 4 options for our SGDR
     # scenarios [7-10] are the same options but for 2 times wider WRNs, i.e., WRN-28-20
     # scenarios [11-20] are the same as [1-10] but for CIFAR-100
+    # add --resume to continue an interrupted run from its last finished epoch,
+    # --profile to add where the training thread spends its time to stat_*.jsonl,
+    # --keep-last N, --keep-best N and --keep-every N to prune the checkpoints
+    # (every one is kept otherwise), --prune-ensemble to let them prune the
+    # snapshot ensemble checkpoints too
     iscenario = int(sys.argv[1])
+    options = sys.argv[2:]
+    resume = '--resume' in options
+    profiler = ts.StackSampler() if '--profile' in options else None
+    keep = {}
+    for name in ('last', 'best', 'every'):
+        if '--keep-' + name in options:
+            keep['keep_' + name] = int(options[options.index('--keep-' + name) + 1])
+    prune_ensemble = '--prune-ensemble' in options
     model = None
 
     dataset = 'CIFAR-100'
@@ -479,4 +570,5 @@ if __name__ == '__main__':
     if (iscenario == 28):   dataset = 'CIFAR-100';    n = 4;  k = 20;  E1 = 60;    E2 = 120;    E3 = 160;  Estart = 10000;   lr = 0.05;
 
     irun = 1
-    main(mode, dataset, iscenario, n, k, num_epochs, model, irun, Te, E1, E2, E3, lr, lr_fac, reg_fac, t0, Estart, dropoutrate, multFactor)
+    main(mode, dataset, iscenario, n, k, num_epochs, model, irun, Te, E1, E2, E3, lr, lr_fac, reg_fac, t0, Estart, dropoutrate, multFactor,
+         prune_ensemble=prune_ensemble, resume=resume, profiler=profiler, **keep)
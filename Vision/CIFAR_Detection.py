@@ -4,79 +4,40 @@ import time
 import string
 import random
 import pickle
+import glob
+from collections import OrderedDict
 
 import numpy as np
 import theano
 import theano.tensor as T
 import lasagne
 import math
-import sklearn.metrics as sk
-import scipy.io as sio
+import detection_metrics as dm
+import cifar_cache
+import logits_cache as lc
+import detector_scores as ds
+import eval_pipeline as ep
+import ood_sources as ood
+import threshold_index as ti
+import knn_index as knn
+import report
 
 from lasagne.nonlinearities import rectify, softmax
 from lasagne.layers import InputLayer, DenseLayer, DropoutLayer, batch_norm, BatchNormLayer
 from lasagne.layers import ElemwiseSumLayer, NonlinearityLayer, GlobalPoolLayer
-from lasagne.layers.dnn import Conv2DDNNLayer as ConvLayer
 from lasagne.init import HeNormal
 from lasagne.layers import Conv2DLayer as ConvLayer
 
-def unpickle(file):
-    import pickle
-    fo = open(file, 'rb')
-    dict = pickle.load(fo, encoding='latin1')
-    fo.close()
-    return dict
-
 def load_data(dataset):
-    xs = []
-    ys = []
-    if dataset == 'CIFAR-10':
-        for j in range(5):
-            d = unpickle('cifar-10-batches-py/data_batch_'+str(j+1))
-            x = d['data']
-            y = d['labels']
-            xs.append(x)
-            ys.append(y)
-
-        d = unpickle('cifar-10-batches-py/test_batch')
-        xs.append(d['data'])
-        ys.append(d['labels'])
-    if dataset == 'CIFAR-100':
-        d = unpickle('cifar-100-python/train')
-        x = d['data']
-        y = d['fine_labels']
-        xs.append(x)
-        ys.append(y)
-
-        d = unpickle('cifar-100-python/test')
-        xs.append(d['data'])
-        ys.append(d['fine_labels'])
-
-    x = np.concatenate(xs)/np.float32(255)
-    y = np.concatenate(ys)
-    x = np.dstack((x[:, :1024], x[:, 1024:2048], x[:, 2048:]))
-    x = x.reshape((x.shape[0], 32, 32, 3)).transpose(0,3,1,2)
-
-    # subtract per-pixel mean
-    pixel_mean = np.mean(x[0:50000],axis=0)
-    x -= pixel_mean
-
-    # create mirrored images
-    X_train = x[0:50000,:,:,:]
-    Y_train = y[0:50000]
-    X_train_flip = X_train[:,:,:,::-1]
-    Y_train_flip = Y_train
-    X_train = np.concatenate((X_train,X_train_flip),axis=0)
-    Y_train = np.concatenate((Y_train,Y_train_flip),axis=0)
-
-    X_test = x[50000:,:,:,:]
-    Y_test = y[50000:]
-
+    # the normalized arrays are built once by cifar_cache.build_cache and
+    # memory-mapped on every later run
+    data = cifar_cache.load_cached(dataset, data_dir='.')
     return dict(
-        X_train=lasagne.utils.floatX(X_train),
-        Y_train=Y_train.astype('int32'),
-        X_test=lasagne.utils.floatX(X_test),
-        Y_test=Y_test.astype('int32'),)
+        X_train=lasagne.utils.floatX(data['X_train']),
+        Y_train=data['Y_train'],
+        X_test=lasagne.utils.floatX(data['X_test']),
+        Y_test=data['Y_test'],
+        pixel_mean=data['pixel_mean'],)
 
 # ##################### Build the neural network model #######################
 
@@ -154,10 +115,32 @@ def ResNet_FullPre_Wide(input_var=None, nout=10,  n=3, k=2, dropoutrate = 0):
     avg_pool = GlobalPoolLayer(bn_post_relu)
 
     # fully connected layer
-    network = DenseLayer(avg_pool, num_units=nout, W=HeNormal(), nonlinearity=softmax)
+    network = DenseLayer(avg_pool, num_units=nout, W=HeNormal(), nonlinearity=lasagne.nonlinearities.identity)
+    network = NonlinearityLayer(network, nonlinearity=softmax)
 
     return network
 
+def load_params(model):
+    with np.load(model) as f:
+        return [f['arr_%d' % i] for i in range(len(f.files))]
+
+def compile_logits_fn(network, input_var, model=None):
+    '''loads the parameters of model (if given) into network and compiles a
+       function mapping a batch of inputs to the pre-softmax outputs; the
+       function reads the network's shared parameters, so later
+       set_all_param_values calls take effect without recompiling'''
+    if model is not None:
+        lasagne.layers.set_all_param_values(network, load_params(model))
+    # the layer below the final softmax gives the pre-softmax outputs
+    logits = lasagne.layers.get_output(network.input_layer, deterministic=True)
+    return theano.function([input_var], logits)
+
+def compile_features_fn(network, input_var):
+    '''compiles a function mapping a batch of inputs to the pooled features
+       that the final dense layer sees'''
+    avg_pool = network.input_layer.input_layer
+    return theano.function([input_var], lasagne.layers.get_output(avg_pool, deterministic=True))
+
 # ############################# Batch iterator ###############################
 
 def iterate_minibatches(inputs, targets, batchsize, shuffle=False, augment=False):
@@ -186,15 +169,16 @@ def iterate_minibatches(inputs, targets, batchsize, shuffle=False, augment=False
         yield inp_exc, targets[excerpt]
 
 def main(dataset = 'CIFAR-10', iscenario = 0, n=5, k = 1, num_epochs=82, model = None, irun = 0, Te = 2.0, E1 = 41, E2 = 61, E3 = 81,
-         lr=0.1, lr_fac=0.1, reg_fac=0.0005, t0=math.pi/2.0, Estart = 0, dropoutrate = 0, multFactor = 1):
+         lr=0.1, lr_fac=0.1, reg_fac=0.0005, t0=math.pi/2.0, Estart = 0, dropoutrate = 0, multFactor = 1, knn_k = 0):
+    # knn_k > 0 adds the distance to the knn_k-th nearest training feature as a detector
     # Check if CIFAR data exists
     if dataset == 'CIFAR-10':
-        if not os.path.exists("./cifar-10-batches-py"):
+        if not cifar_cache.has_data(dataset):
             print("CIFAR-10 dataset can not be found. Please download the dataset from 'https://www.cs.toronto.edu/~kriz/cifar.html'.")
             return
         nout = 10
     if dataset == 'CIFAR-100':
-        if not os.path.exists("./cifar-100-python"):
+        if not cifar_cache.has_data(dataset):
             print("CIFAR-100 dataset can not be found. Please download the dataset from 'https://www.cs.toronto.edu/~kriz/cifar.html'.")
             return
         nout = 100
@@ -205,6 +189,7 @@ def main(dataset = 'CIFAR-10', iscenario = 0, n=5, k = 1, num_epochs=82, model =
     Y_train = data['Y_train']
     X_test = data['X_test']
     Y_test = data['Y_test']
+    pixel_mean = data['pixel_mean']
 
     # Prepare Theano variables for inputs and targets
     input_var = T.tensor4('inputs')
@@ -237,192 +222,100 @@ def main(dataset = 'CIFAR-10', iscenario = 0, n=5, k = 1, num_epochs=82, model =
         # the updates dictionary) and returning the corresponding training loss:
         train_fn = theano.function([input_var, target_var], loss, updates=updates)
 
-    # Create a loss expression for validation/testing
-    test_prediction = lasagne.layers.get_output(network, deterministic=True)
-    test_loss = lasagne.objectives.categorical_crossentropy(test_prediction, target_var)
-
-    # simplification of kl from uniform
-    kl = T.log(nout) + T.sum(test_prediction * T.log(T.abs_(test_prediction) + 1e-10), axis=1, keepdims=True)
-
-    # test_loss = test_loss.mean()
-    right = T.eq(T.argmax(test_prediction, axis=1), target_var)
-
-    # Compile a second function computing the validation loss and accuracy:
-    # val_fn = theano.function([input_var, target_var], [test_loss, test_acc])
-    right_wrong_fn = theano.function([input_var, target_var], [right, kl, T.max(test_prediction, axis=1)])
-
-    with np.load(model) as f:
-        param_values = [f['arr_%d' % i] for i in range(len(f.files))]
-    lasagne.layers.set_all_param_values(network, param_values)
-
-    kl_right, kl_wrong, kl_all, conf_right, conf_wrong, conf_all = [], [], [], [], [], []
-    for batch in iterate_minibatches(X_test, Y_test, 500, shuffle=False):
-        inputs, targets = batch
-        r, kl_a, conf_a = right_wrong_fn(inputs, targets)
-        r = np.array(r, dtype=bool)
-        kl_all.extend(kl_a)
-        kl_right.extend(kl_a[r])
-        kl_wrong.extend(kl_a[np.logical_not(r)])
-        conf_all.extend(conf_a)
-        conf_right.extend(conf_a[r])
-        conf_wrong.extend(conf_a[np.logical_not(r)])
-
-    safe, risky = kl_right, kl_wrong
-    labels = np.zeros((len(safe) + len(risky)), dtype=np.int32)
-    labels[:len(safe)] += 1
-    examples = np.squeeze(np.vstack((safe, risky)))
-
-    print('Classification Accuracy:', len(safe)/(len(safe) + len(risky)))
-    print('Prediction confidence (mean, std):', np.mean(conf_all), np.std(conf_all))
-    print('Prediction confidence right (mean, std):', np.mean(conf_right), np.std(conf_right))
-    print('Prediction confidence wrong (mean, std):', np.mean(conf_wrong), np.std(conf_wrong))
-
-    # print('\nKL[p||u]: Right/Wrong classification distinction')
-    # print('PR', sk.average_precision_score(labels, examples))
-    # print('ROC', sk.roc_auc_score(labels, examples))
-
-    safe, risky = conf_right, conf_wrong
-    labels = np.zeros((len(safe) + len(risky)), dtype=np.int32)
-    labels[:len(safe)] += 1
-    examples = np.squeeze(np.vstack((np.array(safe).reshape(-1, 1), np.array(risky).reshape(-1,1))))
-
-    print('\nPrediction Confidence: Right/Wrong classification distinction')
-    print('AUROC', sk.roc_auc_score(labels, examples))
-    print('AUPR (Succ)', sk.average_precision_score(labels, examples))
-
-    safe, risky = conf_right, conf_wrong
-    labels = np.zeros((len(safe) + len(risky)), dtype=np.int32)
-    labels[len(safe):] += 1
-    examples = np.squeeze(-np.vstack((np.array(safe).reshape(-1, 1), np.array(risky).reshape(-1,1))))
-    print('AUPR (Err)', sk.average_precision_score(labels, examples))
-
-    # OOD detection
-
-    bad_examples = []
-
-    oos_examples = sio.loadmat("./data/sun-train1.mat")['m'].T.reshape((-1,32,32,3)).transpose(0,3,1,2).astype(np.float32)
-    oos_examples -= np.mean(X_train, axis=0)
-
-    kl_oos, conf_oos = [], []
-    for batch in iterate_minibatches(oos_examples, np.zeros(shape=oos_examples.shape[0], dtype=np.int32), 500, shuffle=False):
-        inputs, targets = batch
-        r, kl_a, conf_a = right_wrong_fn(inputs, targets)
-        kl_oos.extend(kl_a)
-        conf_oos.extend(conf_a)
-
-    print('\nPrediction confidence SUN (mean, std):', np.mean(conf_oos), np.std(conf_oos))
-
-    # print('\nKL[p||u]: In/out distribution distinction (from SUN)')
-    # in_sample, oos = kl_all, kl_oos
-    # labels = np.zeros((len(in_sample) + len(oos)), dtype=np.int32)
-    # labels[:len(in_sample)] += 1
-    # examples = np.squeeze(np.vstack((in_sample, oos)))
-    # print('PR', sk.average_precision_score(labels, examples))
-    # print('ROC', sk.roc_auc_score(labels, examples))
-
-    # print('\nPrediction Confidence: In/out distribution distinction (from SUN)')
-    # in_sample, oos = conf_all, conf_oos
-    # labels = np.zeros((len(in_sample) + len(oos)), dtype=np.int32)
-    # labels[:len(in_sample)] += 1
-    # examples = np.squeeze(np.vstack((np.array(in_sample).reshape((-1,1)), np.array(oos).reshape((-1,1)))))
-    # print('PR', sk.average_precision_score(labels, examples))
-    # print('ROC', sk.roc_auc_score(labels, examples))
-
-    # print('\nKL[p||u]: In/out distribution distinction (from SUN; relative to right)')
-    # in_sample, oos = kl_right, kl_oos
-    # labels = np.zeros((len(in_sample) + len(oos)), dtype=np.int32)
-    # labels[:len(in_sample)] += 1
-    # examples = np.squeeze(np.vstack((in_sample, oos)))
-    # print('PR', sk.average_precision_score(labels, examples))
-    # print('ROC', sk.roc_auc_score(labels, examples))
-
-    print('\nPrediction Confidence: In/out distribution distinction (from SUN; relative to right)')
-    in_sample, oos = conf_right, conf_oos
-    labels = np.zeros((len(in_sample) + len(oos)), dtype=np.int32)
-    labels[:len(in_sample)] += 1
-    examples = np.squeeze(np.vstack((np.array(in_sample).reshape((-1,1)), np.array(oos).reshape((-1,1)))))
-    print('AUPR (Succ)', sk.average_precision_score(labels, examples))
-    print('AUROC', sk.roc_auc_score(labels, examples))
-
-    bad_examples.append(conf_oos)
-
-    print('\nPrediction Confidence: In/out distribution distinction (from SUN; relative to right; Err is positive)')
-    in_sample, oos = conf_right, conf_oos
-    labels = np.zeros((len(in_sample) + len(oos)), dtype=np.int32)
-    labels[len(in_sample):] += 1
-    examples = np.squeeze(np.vstack((-np.array(in_sample).reshape((-1,1)), -np.array(oos).reshape((-1,1)))))
-    print('AUPR (Err)', sk.average_precision_score(labels, examples))
-
-    oos_examples = np.random.normal(scale=0.5, size=X_test.shape).astype(np.float32)
-
-    kl_oos, conf_oos = [], []
-    for batch in iterate_minibatches(oos_examples, np.zeros(shape=oos_examples.shape[0], dtype=np.int32), 500, shuffle=False):
-        inputs, targets = batch
-        r, kl_a, conf_a = right_wrong_fn(inputs, targets)
-        kl_oos.extend(kl_a)
-        conf_oos.extend(conf_a)
-
-    print('\nPrediction confidence White Noise (mean, std):', np.mean(conf_oos), np.std(conf_oos))
-
-    # print('\nKL[p||u]: In/out distribution distinction (from white noise)')
-    # in_sample, oos = kl_all, kl_oos
-    # labels = np.zeros((len(in_sample) + len(oos)), dtype=np.int32)
-    # labels[:len(in_sample)] += 1
-    # examples = np.squeeze(np.vstack((in_sample, oos)))
-    # print('PR', sk.average_precision_score(labels, examples))
-    # print('ROC', sk.roc_auc_score(labels, examples))
-
-    # print('\nPrediction Confidence: In/out distribution distinction (from white noise)')
-    # in_sample, oos = conf_all, conf_oos
-    # labels = np.zeros((len(in_sample) + len(oos)), dtype=np.int32)
-    # labels[:len(in_sample)] += 1
-    # examples = np.squeeze(np.vstack((np.array(in_sample).reshape((-1,1)), np.array(oos).reshape((-1,1)))))
-    # print('AUPR (Succ)', sk.average_precision_score(labels, examples))
-    # print('AUROC', sk.roc_auc_score(labels, examples))
-
-    bad_examples.append(conf_oos)
-
-    print('\nKL[p||u]: In/out distribution distinction (from white noise; relative to right)')
-    in_sample, oos = kl_right, kl_oos
-    labels = np.zeros((len(in_sample) + len(oos)), dtype=np.int32)
-    labels[:len(in_sample)] += 1
-    examples = np.squeeze(np.vstack((in_sample, oos)))
-    print('PR (Succ)', sk.average_precision_score(labels, examples))
-    print('ROC', sk.roc_auc_score(labels, examples))
-    in_sample, oos = kl_right, kl_oos
-    labels = np.zeros((len(in_sample) + len(oos)), dtype=np.int32)
-    labels[len(in_sample):] += 1
-    examples = np.squeeze(-np.vstack((in_sample, oos)))
-    print('PR (Err)', sk.average_precision_score(labels, examples))
-
-    print('\nPrediction Confidence: In/out distribution distinction (from white noise; relative to right)')
-    in_sample, oos = conf_right, conf_oos
-    labels = np.zeros((len(in_sample) + len(oos)), dtype=np.int32)
-    labels[:len(in_sample)] += 1
-    examples = np.squeeze(np.vstack((np.array(in_sample).reshape((-1,1)), np.array(oos).reshape((-1,1)))))
-    print('AUPR (succ)', sk.average_precision_score(labels, examples))
-    print('AUROC', sk.roc_auc_score(labels, examples))
-
-    print('\nPrediction Confidence: In/out distribution distinction (white noise; relative to right; Err is positive)')
-    in_sample, oos = conf_right, conf_oos
-    labels = np.zeros((len(in_sample) + len(oos)), dtype=np.int32)
-    labels[len(in_sample):] += 1
-    examples = np.squeeze(np.vstack((-np.array(in_sample).reshape((-1,1)), -np.array(oos).reshape((-1,1)))))
-    print('AUPR (Err)', sk.average_precision_score(labels, examples))
-
-    print('\n\nPrediction Confidence: In/out distribution distinction (from ALL; relative to right)')
-    in_sample, oos = conf_right, np.concatenate(bad_examples)
-    print('In sample examples (right):', len(in_sample), 'OOD examples:', len(oos))
-    labels = np.zeros((len(in_sample) + len(oos)), dtype=np.int32)
-    labels[:len(in_sample)] += 1
-    examples = np.squeeze(np.vstack((np.array(in_sample).reshape((-1,1)), np.array(oos).reshape((-1,1)))))
-    print('AUPR (succ)', sk.average_precision_score(labels, examples))
-    print('AUROC', sk.roc_auc_score(labels, examples))
-    in_sample, oos = conf_right, np.concatenate(bad_examples)
-    labels = np.zeros((len(in_sample) + len(oos)), dtype=np.int32)
-    labels[len(in_sample):] += 1
-    examples = np.squeeze(np.vstack((-np.array(in_sample).reshape((-1,1)), -np.array(oos).reshape((-1,1)))))
-    print('AUPR (Err)', sk.average_precision_score(labels, examples))
+    # model is one checkpoint, a list of them or a glob such as
+    # './data/network_3_1_*.npz'; several checkpoints are scored as a snapshot
+    # ensemble that averages their softmax probabilities
+    if isinstance(model, str):
+        checkpoints = sorted(glob.glob(model)) if any(c in model for c in '*?[') else [model]
+    else:
+        checkpoints = list(model)
+    if not checkpoints:
+        print("No checkpoint matches {}.".format(model))
+        return
+    model_name = os.path.splitext(os.path.basename(checkpoints[0]))[0]
+    if len(checkpoints) > 1:
+        model_name += '_ensemble{}'.format(len(checkpoints))
+        print("Snapshot ensemble of {} checkpoints".format(len(checkpoints)))
+
+    # logits are cached per (checkpoint, dataset), so the network is only
+    # compiled and run for datasets it has not scored before
+    compiled = []
+    def logits_fn(inputs):
+        if not compiled:
+            print("Compiling the inference function...")
+            compiled.append(compile_logits_fn(network, input_var))
+        return compiled[0](inputs)
+
+    # every checkpoint is read from disk once; the compiled function is reused
+    # with each set of parameters in turn
+    param_values = {}
+    def set_params(i):
+        if i not in param_values:
+            param_values[i] = load_params(checkpoints[i])
+        lasagne.layers.set_all_param_values(network, param_values[i])
+
+    def load_sun():
+        # converted to a memory-mapped .npy once, then preprocessed one batch at a time
+        return ood.mat_images("./data/sun-train1.mat", mean=pixel_mean)
+
+    # generated batch by batch from a seeded stream
+    noise = ood.NoiseSource('gaussian', len(X_test), X_test.shape[1:], seed=0, scale=0.5)
+
+    # the in-distribution test set first, then every OOD set; sets are loaded on
+    # a background thread while the network scores the previous one
+    eval_sets = [
+        ep.EvalSet('Test', X_test, in_distribution=True),
+        # the preprocessed images depend on the mean they are centered with
+        ep.EvalSet('SUN', load_sun, lc.combine_keys(dataset, lc.file_hash("./data/sun-train1.mat"),
+                                                    lc.array_fingerprint(pixel_mean))),
+        ep.EvalSet('White Noise', noise, lc.combine_keys(noise.key())),
+    ]
+    all_logits = ep.evaluate_ensemble(logits_fn, set_params, checkpoints, eval_sets)
+    # a single checkpoint keeps its raw logits; an ensemble is represented by
+    # the log of its averaged probabilities
+    all_logits = {name: logits[0] if len(logits) == 1 else ds.ensemble_logits(np.stack(logits))
+                  for name, logits in all_logits.items()}
+
+    logits = all_logits['Test']
+    r = np.argmax(logits, axis=1) == Y_test
+    kl_all, conf_all = ds.kl_uniform(logits), ds.max_softmax(logits)
+
+    # quantile indices of the in-distribution scores, for flagging new examples online
+    for score_name, scores in (('max_softmax', conf_all), ('kl_uniform', kl_all)):
+        fname = './data/threshold_index_{}_{}.npz'.format(model_name, score_name)
+        ti.build_index(scores, score_name=score_name, checkpoint=','.join(checkpoints)).save(fname)
+
+    report.print_logits_report(logits, Y_test, OrderedDict((s.name, all_logits[s.name]) for s in eval_sets
+                                                           if not s.in_distribution))
+
+    if knn_k > 0 and len(checkpoints) > 1:
+        print('\nThe kNN detector needs a single checkpoint; skipped for the ensemble.')
+    elif knn_k > 0:
+        features_compiled = []
+        def features_fn(inputs):
+            if not features_compiled:
+                set_params(0)
+                features_compiled.append(compile_features_fn(network, input_var))
+            return features_compiled[0](inputs)
+
+        # pooled features of the training images, normalized into a
+        # memory-mapped store once per checkpoint
+        store = os.path.join('./data/feature_cache', lc.file_hash(checkpoints[0])[:20], 'knn_{}.npy'.format(dataset))
+        if not os.path.exists(store):
+            print("Extracting training features...")
+            os.makedirs(os.path.dirname(store), exist_ok=True)
+            knn.write_store(lc.compute_logits(features_fn, X_train), store)
+        index = knn.load_store(store)
+
+        all_features = ep.evaluate(features_fn, checkpoints[0], eval_sets, cache_dir='./data/feature_cache')
+        knn_right = dm.sort_scores(index.score(all_features['Test'][r], knn_k))
+        ood_sets = [s for s in eval_sets if not s.in_distribution]
+        knn_oos = [index.score(all_features[s.name], knn_k) for s in ood_sets]
+        for s, scores in zip(ood_sets, knn_oos):
+            print('\n{}-NN distance: In/out distribution distinction (from {}; relative to right)'.format(knn_k, s.name))
+            dm.print_measures(dm.get_measures(knn_right, scores))
+        print('\n{}-NN distance: In/out distribution distinction (from ALL; relative to right)'.format(knn_k))
+        dm.print_measures(dm.get_measures(knn_right, np.concatenate(knn_oos)))
 
 if __name__ == '__main__':
 
@@ -434,6 +327,7 @@ if __name__ == '__main__':
 
     iscenario = 13   #int(sys.argv[1])
     model = './data/network_3_1_49.npz'
+    # model = './data/network_3_1_4[0-9].npz'     # snapshot ensemble of epochs 40-49
     dataset = 'CIFAR-10'
 
     # iscenario = 13   #int(sys.argv[1])
@@ -450,5 +344,6 @@ if __name__ == '__main__':
     multFactor = 1
     num_epochs = 50
     E1 = -1;    E2 = -1;     E3 = -1;   Estart = -1
+    knn_k = 0       # e.g. 50 to add the kNN detector on the pooled features
 
-    main(dataset, iscenario, 6, 4, num_epochs, model, 1, Te, E1, E2, E3, lr, lr_fac, reg_fac, t0, Estart, dropoutrate, multFactor)
+    main(dataset, iscenario, 6, 4, num_epochs, model, 1, Te, E1, E2, E3, lr, lr_fac, reg_fac, t0, Estart, dropoutrate, multFactor, knn_k)
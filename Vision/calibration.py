@@ -0,0 +1,115 @@
+# calibration measures and temperature scaling on stored logits and labels
+#
+# Everything works on cached network outputs (see logits_cache.py), so
+# recalibrating a checkpoint never runs the network.
+
+import sys
+
+import numpy as np
+
+import detector_scores as ds
+
+
+def reliability_bins(confidences, correct, n_bins=15):
+    '''
+    equal-width confidence bins over [0, 1]
+
+    returns a dict with the bin edges and, per bin, the number of examples,
+    their mean confidence and their accuracy (0 for empty bins)
+    '''
+    confidences = np.asarray(confidences, dtype=np.float64).ravel()
+    correct = np.asarray(correct, dtype=np.float64).ravel()
+    edges = np.linspace(0., 1., n_bins + 1)
+    # bins are (lo, hi], with a confidence of exactly 0 in the first bin
+    bins = np.clip(np.searchsorted(edges, confidences, 'left') - 1, 0, n_bins - 1)
+    counts = np.bincount(bins, minlength=n_bins)
+    safe = np.maximum(counts, 1)
+    return {'edges': edges,
+            'counts': counts,
+            'confidence': np.bincount(bins, confidences, minlength=n_bins) / safe,
+            'accuracy': np.bincount(bins, correct, minlength=n_bins) / safe}
+
+
+def calibration_errors(confidences, correct, n_bins=15):
+    '''expected and maximum calibration error over equal-width bins; returns
+       (ECE, MCE, reliability_bins)'''
+    bins = reliability_bins(confidences, correct, n_bins)
+    gap = np.abs(bins['accuracy'] - bins['confidence'])
+    ece = np.sum(bins['counts'] * gap) / float(np.sum(bins['counts']))
+    mce = np.max(gap[bins['counts'] > 0])
+    return ece, mce, bins
+
+
+def alignment(confidences, correct):
+    '''the "calibration" of SGDR_WRNs_gelu.py: mean of (2 conf - 1)(2 right - 1)'''
+    confidences = np.asarray(confidences, dtype=np.float64)
+    sign = 2. * np.asarray(correct, dtype=np.float64) - 1.
+    return np.mean((2. * confidences - 1.) * sign)
+
+
+def model_score(confidences, correct):
+    '''the "model score" of SGDR_WRNs_gelu.py'''
+    confidences = np.asarray(confidences, dtype=np.float64)
+    correct = np.asarray(correct, dtype=np.float64)
+    return np.mean(correct * ((2. * confidences - 1.) * (2. * correct - 1.) + 1.) / 2.)
+
+
+def nll(logits, labels, temperature=1.):
+    log_p = ds.log_softmax(np.asarray(logits, dtype=np.float64) / temperature)
+    return -np.mean(log_p[np.arange(len(labels)), labels])
+
+
+def fit_temperature(logits, labels, max_iter=20, tol=1e-7):
+    '''
+    temperature minimizing the NLL of labels under softmax(logits / T)
+
+    The NLL is convex in beta = 1 / T with derivative E_p[z] - z_y and second
+    derivative Var_p[z] (averaged over examples), so a few Newton steps on
+    beta converge; a step that would make beta <= 0 is halved until beta
+    stays positive.  Both derivatives are unchanged by shifting each row, so
+    the rows are shifted to a maximum of 0 once and every step is one float32
+    exp over the logits.
+    '''
+    z = np.asarray(logits, dtype=np.float32)
+    z = z - np.max(z, axis=1, keepdims=True)
+    z_sq = z * z
+    mean_z_y = np.mean(z[np.arange(len(z)), labels], dtype=np.float64)
+    p = np.empty_like(z)
+    ones = np.ones(z.shape[1], dtype=np.float32)
+    beta = 1.
+    for _ in range(max_iter):
+        np.multiply(z, np.float32(beta), out=p)
+        np.exp(p, out=p)
+        norm = p.dot(ones)
+        mean_z = np.einsum('ij,ij->i', p, z) / norm
+        var_z = np.einsum('ij,ij->i', p, z_sq) / norm - mean_z * mean_z
+        grad = np.mean(mean_z, dtype=np.float64) - mean_z_y
+        hess = np.mean(var_z, dtype=np.float64)
+        if hess <= 0:
+            break
+        step = grad / hess
+        while beta - step <= 0:
+            step /= 2.
+        beta -= step
+        if abs(step) < tol * beta:
+            break
+    return 1. / beta
+
+
+def print_calibration(logits, labels, n_bins=15):
+    '''calibration of logits before and after fitting a temperature'''
+    labels = np.asarray(labels)
+    correct = np.argmax(logits, axis=1) == labels
+    temperature = fit_temperature(logits, labels)
+    for name, t in (('', 1.), (' (T = {:.3f})'.format(temperature), temperature)):
+        conf = ds.max_softmax(np.asarray(logits, dtype=np.float64) / t)
+        ece, mce, _ = calibration_errors(conf, correct, n_bins)
+        print('NLL{}:\t\t{:.4f}'.format(name, nll(logits, labels, t)))
+        print('ECE{}:\t\t{:.2f} %'.format(name, 100 * ece))
+        print('MCE{}:\t\t{:.2f} %'.format(name, 100 * mce))
+
+
+if __name__ == '__main__':
+    # usage: python calibration.py logits.npy labels.npy [n_bins]
+    print_calibration(np.load(sys.argv[1], mmap_mode='r'), np.load(sys.argv[2]),
+                      int(sys.argv[3]) if len(sys.argv) > 3 else 15)
@@ -0,0 +1,143 @@
+# checkpoints written by a background thread, with a retention policy
+#
+# save copies the arrays into snapshot buffers, reused once written, and
+# returns; a writer thread serializes the snapshot with np.savez to a
+# temporary file and renames it into place, so a checkpoint on disk is always
+# complete.  The training thread only waits when it saves while the previous
+# n_buffers snapshots are still being written.
+#
+# After each write the checkpoints saved with an epoch number are pruned to
+# the union of the retention rules:
+#   keep_last:  the keep_last most recent ones
+#   keep_best:  the keep_best ones with the highest score (e.g. validation
+#               accuracy)
+#   keep_every: those whose epoch is a multiple of keep_every
+# With no rule (the default) every checkpoint is kept.  Checkpoints saved
+# without an epoch (e.g. the final one) and those whose file name matches one
+# of the keep_patterns (fnmatch patterns, e.g. the glob of a snapshot
+# ensemble) are always kept.
+
+import os
+import fnmatch
+import time
+import queue
+import threading
+
+import numpy as np
+
+
+def retained(records, keep_last=None, keep_best=None, keep_every=None, keep_patterns=()):
+    '''
+    the file names among records (dicts with fname, epoch, score, in save
+    order) that the retention rules keep
+    '''
+    if keep_last is None and keep_best is None and keep_every is None:
+        return set(r['fname'] for r in records)
+    keep = set(r['fname'] for r in records if r['epoch'] is None
+               or any(fnmatch.fnmatch(r['fname'], p) for p in keep_patterns))
+    numbered = [r for r in records if r['epoch'] is not None]
+    if keep_last:
+        keep.update(r['fname'] for r in numbered[-keep_last:])
+    if keep_best:
+        scored = [r for r in numbered if r['score'] is not None]
+        keep.update(r['fname'] for r in sorted(scored, key=lambda r: r['score'], reverse=True)[:keep_best])
+    if keep_every:
+        keep.update(r['fname'] for r in numbered if r['epoch'] % keep_every == 0)
+    return keep
+
+
+class CheckpointWriter(object):
+    '''
+    keep_last, keep_best, keep_every: retention rules, see above
+    keep_patterns: fnmatch patterns of file names that are never pruned
+    n_buffers: snapshots that may wait for the writer before save blocks
+    saved: the saved list of an earlier writer, so that a resumed run keeps
+           pruning the checkpoints written before it
+    '''
+    def __init__(self, keep_last=None, keep_best=None, keep_every=None, keep_patterns=(), n_buffers=2, saved=None):
+        self.keep_last, self.keep_best, self.keep_every = keep_last, keep_best, keep_every
+        self.keep_patterns = list(keep_patterns)
+        # every save so far (fname, epoch, score), as seen by the caller
+        self.saved = [dict(r) for r in saved or [] if os.path.exists(r['fname'])]
+        # what the writer thread has written and not pruned
+        self.records = [dict(r) for r in self.saved]
+        self.error = None
+        # seconds the writer thread has spent writing and pruning
+        self.write_seconds = 0.
+        self.slots = threading.Semaphore(n_buffers)
+        self.free = {}
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, fname, arrays, epoch=None, score=None):
+        '''
+        queues the arrays to be written to fname as np.savez(fname, *arrays),
+        i.e. in the format of lasagne.layers.get_all_param_values, or as
+        np.savez(fname, **arrays) if arrays is a dict; the arrays are copied
+        before save returns
+        '''
+        self._raise()
+        names = list(arrays.keys()) if isinstance(arrays, dict) else None
+        arrays = [np.asarray(a) for a in (arrays.values() if names is not None else arrays)]
+        self.slots.acquire()
+        buffers = []
+        with self.lock:
+            for a in arrays:
+                # scalars are not worth keeping
+                free = self.free.get((a.shape, a.dtype.str)) if a.ndim else None
+                buffers.append(free.pop() if free else np.empty(a.shape, dtype=a.dtype))
+        for b, a in zip(buffers, arrays):
+            np.copyto(b, a)
+        score = None if score is None else float(score)
+        self.saved = [r for r in self.saved if r['fname'] != fname]
+        self.saved.append({'fname': fname, 'epoch': epoch, 'score': score})
+        self.pending.put((fname, names, buffers, epoch, score))
+
+    def close(self):
+        '''waits until every checkpoint is written and stops the writer'''
+        self.pending.put(None)
+        self.thread.join()
+        self._raise()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            fname, names, buffers, epoch, score = item
+            start = time.time()
+            try:
+                self._write(fname, names, buffers)
+                self.records = [r for r in self.records if r['fname'] != fname]
+                self.records.append({'fname': fname, 'epoch': epoch, 'score': score})
+                keep = retained(self.records, self.keep_last, self.keep_best, self.keep_every, self.keep_patterns)
+                for r in self.records:
+                    if r['fname'] not in keep and os.path.exists(r['fname']):
+                        os.remove(r['fname'])
+                self.records = [r for r in self.records if r['fname'] in keep]
+            except Exception as e:
+                # raised again by the next save or close
+                self.error = e
+            self.write_seconds += time.time() - start
+            with self.lock:
+                for b in buffers:
+                    if b.ndim:
+                        self.free.setdefault((b.shape, b.dtype.str), []).append(b)
+            self.slots.release()
+
+    @staticmethod
+    def _write(fname, names, arrays):
+        tmp = fname + '.tmp{}'.format(os.getpid())
+        with open(tmp, 'wb') as f:
+            if names is None:
+                np.savez(f, *arrays)
+            else:
+                np.savez(f, **dict(zip(names, arrays)))
+        os.replace(tmp, fname)
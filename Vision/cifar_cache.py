@@ -0,0 +1,227 @@
+# preprocessed CIFAR tensors, cached on disk and memory-mapped on load
+#
+# Building the normalized training tensor from the pickled batches costs
+# several GB of temporaries and is identical on every run.  build_cache does it
+# once and writes plain .npy files; load_cached opens them with mmap_mode so that
+# start-up is a few page faults and concurrent evaluation processes share one
+# copy through the page cache.
+#
+# The batches are read from the extracted folder if there is one, otherwise
+# straight out of the downloaded archive, without extracting it.
+#
+# usage: python cifar_cache.py CIFAR-10 [directory holding cifar-10-batches-py or cifar-10-python.tar.gz]
+
+import os
+import sys
+import pickle
+import shutil
+import tarfile
+
+import numpy as np
+
+# bump whenever the preprocessing below changes so that stale caches are rebuilt
+CACHE_VERSION = 2
+
+ARRAYS = ('X_train', 'Y_train', 'X_test', 'Y_test', 'pixel_mean')
+
+
+# dataset -> (archive, folder it extracts to, training batches, test batch, label key)
+LAYOUTS = {
+    'CIFAR-10': ('cifar-10-python.tar.gz', 'cifar-10-batches-py',
+                 ['data_batch_' + str(j + 1) for j in range(5)], 'test_batch', 'labels'),
+    'CIFAR-100': ('cifar-100-python.tar.gz', 'cifar-100-python', ['train'], 'test', 'fine_labels'),
+}
+
+
+class _RawArray(object):
+    '''stands in for a pickled ndarray and wraps its raw bytes with
+       np.frombuffer instead of copying them into a new array'''
+    def __setstate__(self, state):
+        _, shape, dtype, is_fortran, rawdata = state
+        self.array = np.frombuffer(rawdata, dtype=dtype).reshape(shape, order='F' if is_fortran else 'C')
+
+
+class _BatchUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if name == '_reconstruct' and module in ('numpy.core.multiarray', 'numpy._core.multiarray'):
+            return lambda *args: _RawArray()
+        return pickle.Unpickler.find_class(self, module, name)
+
+
+def _decode(value):
+    '''Python 2 str (read as bytes) to str, also inside lists'''
+    if isinstance(value, bytes):
+        return value.decode('latin1')
+    if isinstance(value, list) and value and isinstance(value[0], bytes):
+        return [v.decode('latin1') for v in value]
+    return value
+
+
+def load_pickle(f):
+    '''unpickles a CIFAR batch from the file object f; arrays are read-only
+       views of the bytes read'''
+    # encoding='bytes' hands the Python 2 str payload of an array to
+    # np.frombuffer as read, where 'latin1' would decode it into a new str
+    d = _BatchUnpickler(f, encoding='bytes').load()
+    return {_decode(k): v.array if isinstance(v, _RawArray) else _decode(v) for k, v in d.items()}
+
+
+def unpickle(file):
+    with open(file, 'rb') as fo:
+        return load_pickle(fo)
+
+
+def read_archive(tarpath, names):
+    '''returns {name: unpickled batch} for the members of tarpath whose base
+       name is in names, streaming through the archive once'''
+    batches = {}
+    with tarfile.open(tarpath, 'r:gz') as tar:
+        for member in tar:
+            name = os.path.basename(member.name)
+            if member.isfile() and name in names:
+                batches[name] = load_pickle(tar.extractfile(member))
+    missing = set(names) - set(batches)
+    if missing:
+        raise IOError('{} lacks {}'.format(tarpath, ', '.join(sorted(missing))))
+    return batches
+
+
+def read_folder(folder, tarpath, names):
+    '''returns {name: unpickled batch} from folder if every one of names was
+       extracted there, otherwise streamed straight out of the archive tarpath'''
+    if all(os.path.exists(os.path.join(folder, n)) for n in names):
+        return {n: unpickle(os.path.join(folder, n)) for n in names}
+    return read_archive(tarpath, names)
+
+
+def read_batches(dataset, data_dir='.', names=None):
+    '''returns {name: unpickled batch} from the extracted folder in data_dir
+       if present, else from the archive in data_dir; names defaults to every
+       training and test batch'''
+    if dataset not in LAYOUTS:
+        raise ValueError('unknown dataset: ' + str(dataset))
+    archive, folder, train, test, _ = LAYOUTS[dataset]
+    names = train + [test] if names is None else names
+    return read_folder(os.path.join(data_dir, folder), os.path.join(data_dir, archive), names)
+
+
+def raw_batches(dataset, data_dir='.'):
+    '''returns [(data, labels)] for the training batches and for the test batch;
+       data are the raw uint8 rows of the pickles'''
+    batches = read_batches(dataset, data_dir)
+    _, _, train, test, key = LAYOUTS[dataset]
+    return [(batches[n]['data'], batches[n][key]) for n in train], (batches[test]['data'], batches[test][key])
+
+
+def fill_images(batches, label_key, randomize, uint8=False):
+    '''
+    copies the rows of the batches into one preallocated uint8 (N, 32, 32, 3)
+    array, shuffled on the way in when randomize is True, and returns it with
+    the labels; this is the NHWC layout of load_cifar10.py and load_cifar100.py
+
+    uint8: the images stay uint8 (scale the minibatches with normalize), so
+    slicing the result, e.g. into a train/val split, gives views of the one
+    array holding them; otherwise they are returned as floats in [0, 1]
+    '''
+    n = sum(len(b['data']) for b in batches)
+    X = np.empty((n, 32, 32, 3), dtype=np.uint8)
+    Y = np.empty(n, dtype=np.int64)
+    # row i of the result is row perm[i] of the batches, i.e. row j goes to inverse[j]
+    inverse = np.argsort(np.random.permutation(n)) if randomize is True else None
+    start = 0
+    for b in batches:
+        stop = start + len(b['data'])
+        rows = slice(start, stop) if inverse is None else inverse[start:stop]
+        X[rows] = b['data'].reshape((-1, 3, 32, 32)).transpose(0, 2, 3, 1)
+        Y[rows] = b[label_key]
+        start = stop
+    return (X if uint8 else X / 255.), Y
+
+
+def normalize(X):
+    '''uint8 images to float32 in [0, 1], e.g. one minibatch at a time'''
+    return np.divide(X, np.float32(255), dtype=np.float32)
+
+
+def cache_path(dataset, cache_dir='./data/cifar_cache'):
+    return os.path.join(cache_dir, '{}-v{}'.format(dataset, CACHE_VERSION))
+
+
+def build_cache(dataset, data_dir='.', cache_dir='./data/cifar_cache'):
+    '''writes the preprocessed arrays of dataset to cache_path(dataset, cache_dir)'''
+    train, test = raw_batches(dataset, data_dir)
+    n_train = sum(len(y) for _, y in train)
+
+    path = cache_path(dataset, cache_dir)
+    tmp = path + '.tmp{}'.format(os.getpid())
+    os.makedirs(tmp)
+
+    def new(name, shape, dtype):
+        return np.lib.format.open_memmap(os.path.join(tmp, name + '.npy'), mode='w+', dtype=dtype, shape=shape)
+
+    # a row of a CIFAR pickle is the R, G and B planes one after another,
+    # i.e. it is already a (3, 32, 32) NCHW image
+    # no mirrored copies, the training iterator flips images on the fly
+    X_train = new('X_train', (n_train, 3, 32, 32), np.float32)
+    Y_train = new('Y_train', (n_train,), np.int32)
+    pixel_sum = np.zeros((3, 32, 32), dtype=np.float64)
+    start = 0
+    for data, labels in train:
+        stop = start + len(labels)
+        X_train[start:stop] = data.reshape((-1, 3, 32, 32))
+        X_train[start:stop] /= np.float32(255)
+        Y_train[start:stop] = labels
+        pixel_sum += np.sum(X_train[start:stop], axis=0, dtype=np.float64)
+        start = stop
+
+    # subtract per-pixel mean
+    pixel_mean = (pixel_sum / n_train).astype(np.float32)
+    for start in range(0, n_train, 10000):
+        X_train[start:start + 10000] -= pixel_mean
+
+    data, labels = test
+    X_test = new('X_test', (len(labels), 3, 32, 32), np.float32)
+    X_test[:] = data.reshape((-1, 3, 32, 32))
+    X_test /= np.float32(255)
+    X_test -= pixel_mean
+    Y_test = new('Y_test', (len(labels),), np.int32)
+    Y_test[:] = labels
+
+    np.save(os.path.join(tmp, 'pixel_mean.npy'), pixel_mean)
+    for arr in (X_train, Y_train, X_test, Y_test):
+        arr.flush()
+    del X_train, Y_train, X_test, Y_test
+
+    # another process may have finished the same build in the meantime
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        shutil.rmtree(tmp)
+        if not os.path.isdir(path):
+            raise
+    return path
+
+
+def load_cached(dataset, data_dir='.', cache_dir='./data/cifar_cache', mmap_mode='r'):
+    '''returns dict(X_train, Y_train, X_test, Y_test, pixel_mean), building the
+       cache from the pickles in data_dir the first time'''
+    path = cache_path(dataset, cache_dir)
+    if not os.path.isdir(path):
+        print('Building the {} cache in {}...'.format(dataset, path))
+        build_cache(dataset, data_dir, cache_dir)
+    return {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name in ARRAYS}
+
+
+def has_data(dataset, data_dir='.', cache_dir='./data/cifar_cache'):
+    '''True if dataset can be loaded, either from the cache or from the pickles'''
+    if os.path.isdir(cache_path(dataset, cache_dir)):
+        return True
+    archive, folder = LAYOUTS[dataset][:2]
+    return os.path.exists(os.path.join(data_dir, folder)) or os.path.exists(os.path.join(data_dir, archive))
+
+
+if __name__ == '__main__':
+    dataset = sys.argv[1] if len(sys.argv) > 1 else 'CIFAR-10'
+    data_dir = sys.argv[2] if len(sys.argv) > 2 else '.'
+    cache_dir = sys.argv[3] if len(sys.argv) > 3 else './data/cifar_cache'
+    print('Cache written to', build_cache(dataset, data_dir, cache_dir))
@@ -0,0 +1,199 @@
+# misclassification / out-of-distribution detection measures
+#
+# Every comparison in the paper is "in-distribution (or correctly classified)
+# scores are positive, the rest are negative".  Instead of building a label
+# vector and calling sklearn once per (in, out, direction) triple, we sort the
+# in-distribution scores once and merge each out-of-distribution set into them.
+# A single pass over the merged run then yields all measures together.
+# Ties count half, as in sklearn.metrics.roc_auc_score.
+
+import numpy as np
+
+
+def sort_scores(scores):
+    '''returns a flat, ascending copy of scores; sort the in-distribution
+       scores with this once and pass the result to every get_measures call'''
+    return np.sort(np.asarray(scores).ravel())
+
+
+def _merge(in_sorted, out_sorted):
+    '''merges two ascending score arrays; returns the merge order (indices into
+       the concatenation of both) and the last position of every run of tied
+       scores in the merged array'''
+    merged = np.concatenate((in_sorted, out_sorted))
+    # both halves are already sorted, so the stable sort is a linear merge
+    order = np.argsort(merged, kind='mergesort')
+    merged = merged[order]
+    ends = np.flatnonzero(merged[1:] != merged[:-1])
+    ends = np.append(ends, len(merged) - 1)
+    return order, ends
+
+
+def _measures(in_le, out_le, n_in, n_out, recall_level):
+    '''in_le, out_le: number of in / out scores <= each distinct score value,
+       in ascending order'''
+    in_eq = np.diff(in_le, prepend=0)
+    out_eq = np.diff(out_le, prepend=0)
+
+    # counts above each distinct value, i.e. for the threshold "score >= v"
+    in_ge = n_in - in_le + in_eq
+    out_ge = n_out - out_le + out_eq
+
+    # Mann-Whitney statistic: an out score loses to every strictly larger in
+    # score and ties with the in scores at the same value
+    auroc = np.sum(out_eq * (n_in - in_le + 0.5 * in_eq)) / (float(n_in) * n_out)
+
+    # average precision only accumulates where recall moves, i.e. where the
+    # positives of that direction sit
+    aupr_succ = np.sum(in_eq * (in_ge / (in_ge + out_ge).astype(np.float64))) / n_in
+    aupr_err = np.sum(out_eq * (out_le / (out_le + in_le).astype(np.float64))) / n_out
+
+    tpr = in_ge / float(n_in)
+    fpr = out_ge / float(n_out)
+    # tpr is non-increasing in the threshold; take the tightest one that
+    # still reaches the requested recall
+    last = np.flatnonzero(tpr >= recall_level)[-1]
+
+    # a threshold above every score gives TPR = FPR = 0
+    detection_error = min(0.5, np.min(0.5 * (1 - tpr) + 0.5 * fpr))
+
+    return {'AUROC': float(auroc),
+            'AUPR (Succ)': float(aupr_succ),
+            'AUPR (Err)': float(aupr_err),
+            'FPR': float(fpr[last]),
+            'Detection error': float(detection_error)}
+
+
+def get_measures(in_sorted, out_scores, recall_level=0.95):
+    '''
+    in_sorted: in-distribution (or correctly classified) scores, already passed
+               through sort_scores; higher means "more in-distribution"
+    out_scores: out-of-distribution (or misclassified) scores, any order
+    recall_level: in-distribution TPR at which the FPR is reported
+
+    returns a dict with
+       AUROC
+       AUPR (Succ): average precision with in-distribution as positive
+       AUPR (Err): average precision with out-of-distribution as positive
+                   and negated scores
+       FPR: fraction of out-of-distribution scores kept when the threshold
+            keeps recall_level of the in-distribution scores
+       Detection error: min over thresholds of 0.5 (1 - TPR) + 0.5 FPR
+    '''
+    out_sorted = sort_scores(out_scores)
+    n_in, n_out = len(in_sorted), len(out_sorted)
+    if n_in == 0 or n_out == 0:
+        raise ValueError('need at least one in-distribution and one out-of-distribution score')
+
+    order, ends = _merge(in_sorted, out_sorted)
+    in_le = np.cumsum(order < n_in, dtype=np.int64)[ends]
+    out_le = ends + 1 - in_le
+    return _measures(in_le, out_le, n_in, n_out, recall_level)
+
+
+def _normal_quantile(p):
+    from statistics import NormalDist
+    return NormalDist().inv_cdf(p)
+
+
+def delong_ci(in_sorted, out_scores, alpha=0.05):
+    '''
+    AUROC with its DeLong standard error and the (1 - alpha) normal confidence
+    interval; O(n log n) through the structural components of the
+    Mann-Whitney statistic
+
+    returns (auroc, std, lower, upper)
+    '''
+    out_sorted = sort_scores(out_scores)
+    n_in, n_out = len(in_sorted), len(out_sorted)
+    if n_in < 2 or n_out < 2:
+        raise ValueError('need at least two in-distribution and two out-of-distribution scores')
+
+    # fraction of out scores each in score beats (ties count half), and
+    # fraction of in scores that beat each out score
+    v_in = (np.searchsorted(out_sorted, in_sorted, 'left') +
+            np.searchsorted(out_sorted, in_sorted, 'right')) / (2. * n_out)
+    v_out = 1 - (np.searchsorted(in_sorted, out_sorted, 'left') +
+                 np.searchsorted(in_sorted, out_sorted, 'right')) / (2. * n_in)
+
+    auroc = np.mean(v_in)
+    std = np.sqrt(np.var(v_in, ddof=1) / n_in + np.var(v_out, ddof=1) / n_out)
+    z = _normal_quantile(1 - alpha / 2.)
+    return auroc, std, max(0., auroc - z * std), min(1., auroc + z * std)
+
+
+def bootstrap_ci(in_sorted, out_scores, n_boot=1000, alpha=0.05, seed=0, chunk_size=None):
+    '''
+    percentile bootstrap confidence intervals for AUROC, AUPR (Succ) and
+    AUPR (Err)
+
+    In and out scores are resampled separately.  A resample only changes how
+    often each score is counted, so every replicate is a row of draw counts
+    over the fixed sorted scores; the ranks are looked up once and chunk_size
+    replicates are evaluated together with cumulative sums over those rows.
+
+    returns a dict measure -> (lower, upper)
+    '''
+    in_sorted = np.asarray(in_sorted)
+    out_sorted = sort_scores(out_scores)
+    n_in, n_out = len(in_sorted), len(out_sorted)
+    if n_in == 0 or n_out == 0:
+        raise ValueError('need at least one in-distribution and one out-of-distribution score')
+    if chunk_size is None:
+        # about 4M counts per chunk
+        chunk_size = max(1, min(n_boot, (1 << 22) // (n_in + n_out)))
+
+    # positions of the tie boundaries of every score within both sorted arrays
+    in_lt_in = np.searchsorted(in_sorted, in_sorted, 'left')
+    out_lt_in = np.searchsorted(out_sorted, in_sorted, 'left')
+    out_le_in = np.searchsorted(out_sorted, in_sorted, 'right')
+    in_le_out = np.searchsorted(in_sorted, out_sorted, 'right')
+    out_le_out = np.searchsorted(out_sorted, out_sorted, 'right')
+
+    rng = np.random.default_rng(seed)
+
+    def counts(size, rows):
+        # cumulative draw counts, with a leading 0, when resampling rows x size
+        draws = rng.integers(0, size, size=(rows, size), dtype=np.int32) + (size * np.arange(rows, dtype=np.int32))[:, None]
+        w = np.bincount(draws.ravel(), minlength=rows * size).reshape(rows, size).astype(np.float32)
+        c = np.zeros((rows, size + 1), dtype=np.float32)
+        np.cumsum(w, axis=1, out=c[:, 1:])
+        return w, c
+
+    replicates = {'AUROC': [], 'AUPR (Succ)': [], 'AUPR (Err)': []}
+    for start in range(0, n_boot, chunk_size):
+        rows = min(chunk_size, n_boot - start)
+        w_in, c_in = counts(n_in, rows)
+        w_out, c_out = counts(n_out, rows)
+
+        out_lt = c_out[:, out_lt_in]
+        out_le = c_out[:, out_le_in]
+        replicates['AUROC'].append(np.sum(w_in * (out_lt + 0.5 * (out_le - out_lt)), axis=1) / (float(n_in) * n_out))
+
+        # precision at the threshold of every in score (in is positive); the
+        # guarded denominators are only 0 for scores drawn 0 times
+        tp = n_in - c_in[:, in_lt_in]
+        replicates['AUPR (Succ)'].append(np.sum(w_in * (tp / np.maximum(tp + n_out - out_lt, 1)), axis=1) / n_in)
+
+        # precision at the negated threshold of every out score (out is positive)
+        tp = c_out[:, out_le_out]
+        replicates['AUPR (Err)'].append(np.sum(w_out * (tp / np.maximum(tp + c_in[:, in_le_out], 1)), axis=1) / n_out)
+
+    return {k: tuple(np.percentile(np.concatenate(v), [100 * alpha / 2., 100 * (1 - alpha / 2.)]))
+            for k, v in replicates.items()}
+
+
+def print_measures(measures, recall_level=0.95):
+    print('AUROC', measures['AUROC'])
+    print('AUPR (Succ)', measures['AUPR (Succ)'])
+    print('AUPR (Err)', measures['AUPR (Err)'])
+    print('FPR ({}% TPR)'.format(int(100 * recall_level)), measures['FPR'])
+    print('Detection error', measures['Detection error'])
+
+
+def print_intervals(in_sorted, out_scores, alpha=0.05, n_boot=1000):
+    auroc, std, lower, upper = delong_ci(in_sorted, out_scores, alpha)
+    print('AUROC {:.0f}% CI (DeLong)'.format(100 * (1 - alpha)), (lower, upper))
+    ci = bootstrap_ci(in_sorted, out_scores, n_boot, alpha)
+    print('AUPR (Succ) {:.0f}% CI (bootstrap)'.format(100 * (1 - alpha)), ci['AUPR (Succ)'])
+    print('AUPR (Err) {:.0f}% CI (bootstrap)'.format(100 * (1 - alpha)), ci['AUPR (Err)'])
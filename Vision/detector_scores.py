@@ -0,0 +1,106 @@
+# detector scores computed in NumPy from the network's pre-softmax outputs
+
+import numpy as np
+
+
+def log_softmax(logits):
+    logits = np.asarray(logits, dtype=np.float64)
+    shifted = logits - np.max(logits, axis=-1, keepdims=True)
+    return shifted - np.log(np.sum(np.exp(shifted), axis=-1, keepdims=True))
+
+
+def softmax(logits):
+    return np.exp(log_softmax(logits))
+
+
+def max_softmax(logits):
+    '''the baseline score: maximum softmax probability'''
+    return np.exp(np.max(log_softmax(logits), axis=-1))
+
+
+def kl_uniform(logits):
+    '''KL[p||u] = log(C) + sum_c p_c log p_c'''
+    log_p = log_softmax(logits)
+    return np.log(log_p.shape[-1]) + np.sum(np.exp(log_p) * log_p, axis=-1)
+
+
+def max_logit(logits):
+    return np.max(logits, axis=-1)
+
+
+def margin(logits):
+    '''difference between the two largest softmax probabilities'''
+    p = np.sort(softmax(logits), axis=-1)
+    return p[..., -1] - p[..., -2]
+
+
+def neg_entropy(logits):
+    log_p = log_softmax(logits)
+    return np.sum(np.exp(log_p) * log_p, axis=-1)
+
+
+def energy(logits, temperature=1.):
+    '''negative free energy T log sum_c exp(z_c / T); larger is more in-distribution'''
+    z = np.asarray(logits, dtype=np.float64) / temperature
+    m = np.max(z, axis=-1)
+    return temperature * (m + np.log(np.sum(np.exp(z - m[..., None]), axis=-1)))
+
+
+def ensemble_logits(logits):
+    '''
+    log of the softmax probabilities averaged over the first axis, e.g. over the
+    (K, N, C) logits of K snapshots; softmax of the result is the averaged
+    distribution, so every score below applies to the ensemble unchanged
+    '''
+    log_p = log_softmax(logits)
+    m = np.max(log_p, axis=0)
+    return m + np.log(np.mean(np.exp(log_p - m), axis=0))
+
+
+# every score below is oriented so that larger means "more in-distribution"
+TEMPERATURE_FAMILIES = ('max_softmax', 'kl_uniform', 'neg_entropy', 'energy')
+
+
+def temperature_scores(logits, temperatures, chunk_size=None):
+    '''
+    all TEMPERATURE_FAMILIES at every temperature from one (N, T, C) broadcast
+    of logits / temperatures, evaluated chunk_size examples at a time to bound
+    memory
+
+    returns a dict family -> (N, len(temperatures)) array
+    '''
+    logits = np.asarray(logits, dtype=np.float64)
+    temperatures = np.asarray(temperatures, dtype=np.float64).ravel()
+    n, c = logits.shape
+    if chunk_size is None:
+        # about 4M entries of the (chunk, T, C) tensor at a time
+        chunk_size = max(1, (1 << 22) // (len(temperatures) * c))
+
+    out = {f: np.empty((n, len(temperatures)), dtype=np.float64) for f in TEMPERATURE_FAMILIES}
+    for start in range(0, n, chunk_size):
+        z = logits[start:start + chunk_size, None, :] / temperatures[None, :, None]
+        z -= np.max(z, axis=-1, keepdims=True)
+        p = np.exp(z)
+        norm = np.sum(p, axis=-1)
+        p /= norm[..., None]
+        # log p = z - log_norm, and the shifted maximum of z is 0
+        log_norm = np.log(norm)
+        neg_ent = np.sum(p * z, axis=-1) - log_norm
+        rows = slice(start, start + len(z))
+        out['max_softmax'][rows] = np.exp(-log_norm)
+        out['neg_entropy'][rows] = neg_ent
+        out['kl_uniform'][rows] = np.log(c) + neg_ent
+        out['energy'][rows] = temperatures * (np.max(logits[rows], axis=-1)[:, None] / temperatures + log_norm)
+    return out
+
+
+def all_scores(logits, temperatures=(1.,)):
+    '''
+    every detector score as a flat dict name -> (N,) array, e.g.
+    'max_softmax T=1'; temperature families come from one temperature_scores call
+    '''
+    scores = {'max_logit': max_logit(logits), 'margin': margin(logits)}
+    for family, values in temperature_scores(logits, temperatures).items():
+        for j, t in enumerate(np.ravel(temperatures)):
+            scores['{} T={:g}'.format(family, t)] = values[:, j]
+    return scores
@@ -0,0 +1,149 @@
+# sliding-window drift monitor for detector scores
+#
+# Compares the scores of recent traffic with the in-distribution reference
+# scores (e.g. max_softmax of the test set, or the ThresholdIndex written by
+# CIFAR_Detection.py).  Each event is placed once, with a binary search, in
+# three sets of counters that are updated in O(1) as events enter and leave a
+# time window:
+#
+#   KS:    counts between n_bins reference quantiles; the KS distance is the
+#          largest gap between the window and reference CDFs at those
+#          quantiles, i.e. exact to 1 / n_bins
+#   PSI:   counts between psi_bins reference quantiles (deciles by default)
+#   AUROC: sum over the window of the reference CDF at each score (ties
+#          count half), so AUROC(reference vs window) = 1 - sum / count is
+#          exact
+#
+# The statistics are read from the counters, never from the events, so
+# checking for alerts costs O(n_bins) whatever the length of the window.
+
+import time
+from collections import deque
+
+import numpy as np
+
+# alert when a statistic exceeds its threshold (AUROC: moves away from 0.5)
+DEFAULT_THRESHOLDS = {'KS': 0.1, 'PSI': 0.2, 'AUROC': 0.1}
+
+
+def reference_cdf(scores):
+    '''(values, levels): the distinct reference scores and the fraction of
+       reference scores <= each'''
+    values, counts = np.unique(np.asarray(scores).ravel(), return_counts=True)
+    return values, np.cumsum(counts) / float(np.sum(counts))
+
+
+def index_cdf(index):
+    '''(values, levels) of a threshold_index.ThresholdIndex'''
+    return index.quantiles, index.levels
+
+
+class DriftMonitor(object):
+    '''
+    values, levels: reference CDF, see reference_cdf and index_cdf
+    window: length of the window in seconds
+    thresholds: dict statistic -> alert threshold, defaults to DEFAULT_THRESHOLDS
+    min_count: no alerts while the window holds fewer events
+    on_alert: called as on_alert(statistic, value) when a statistic crosses
+              its threshold (again after having gone back below it)
+    '''
+    def __init__(self, values, levels, window=3600., n_bins=1000, psi_bins=10, thresholds=None,
+                 min_count=200, on_alert=None):
+        self.values = np.asarray(values, dtype=np.float64)
+        self.levels = np.asarray(levels, dtype=np.float64)
+        self.window = window
+        self.thresholds = dict(DEFAULT_THRESHOLDS if thresholds is None else thresholds)
+        self.min_count = min_count
+        self.on_alert = on_alert
+        self.alerting = set()
+
+        self.ks_edges, self.ks_levels = self._quantile_edges(n_bins)
+        psi_edges, psi_levels = self._quantile_edges(psi_bins)
+        self.psi_edges = psi_edges
+        self.psi_expected = np.diff(np.concatenate([[0.], psi_levels, [1.]]))
+        self.ks_counts = np.zeros(len(self.ks_edges) + 1, dtype=np.int64)
+        self.psi_counts = np.zeros(len(psi_edges) + 1, dtype=np.int64)
+        self.cdf_sum = 0.
+        self.count = 0
+        # batches of (timestamps, ks bins, psi bins, reference cdf) in arrival order
+        self.events = deque()
+
+    def _quantile_edges(self, n):
+        '''reference values at the levels k / n, 0 < k < n'''
+        idx = np.unique(np.searchsorted(self.levels, np.arange(1, n) / float(n)))
+        idx = idx[idx < len(self.values)]
+        return self.values[idx], self.levels[idx]
+
+    def _cdf(self, scores):
+        '''fraction of reference scores below each score, ties counting half'''
+        def le(side):
+            i = np.searchsorted(self.values, scores, side) - 1
+            return np.where(i >= 0, self.levels[np.maximum(i, 0)], 0.)
+        return 0.5 * (le('right') + le('left'))
+
+    def _count(self, batch, weight):
+        _, ks_bins, psi_bins, cdf = batch
+        np.add.at(self.ks_counts, ks_bins, weight)
+        np.add.at(self.psi_counts, psi_bins, weight)
+        self.cdf_sum += weight * np.sum(cdf)
+        self.count += weight * len(cdf)
+
+    def add(self, scores, timestamps=None):
+        '''adds a batch of scores (arriving now, unless timestamps are given in
+           non-decreasing order), expires old events and checks the alerts;
+           returns the statistics'''
+        scores = np.asarray(scores, dtype=np.float64).ravel()
+        if timestamps is None:
+            timestamps = np.full(len(scores), time.time())
+        batch = (np.asarray(timestamps, dtype=np.float64),
+                 np.searchsorted(self.ks_edges, scores, 'left'),
+                 np.searchsorted(self.psi_edges, scores, 'left'),
+                 self._cdf(scores))
+        self.events.append(batch)
+        self._count(batch, 1)
+        self.expire(batch[0][-1] if len(scores) else time.time())
+        return self.check()
+
+    def expire(self, now):
+        '''drops the events older than the window'''
+        cutoff = now - self.window
+        while self.events:
+            batch = self.events[0]
+            n_old = np.searchsorted(batch[0], cutoff, 'left')
+            if n_old == 0:
+                break
+            self._count(tuple(a[:n_old] for a in batch), -1)
+            if n_old == len(batch[0]):
+                self.events.popleft()
+            else:
+                self.events[0] = tuple(a[n_old:] for a in batch)
+
+    def statistics(self):
+        '''dict with the window size and its KS, PSI and AUROC against the reference'''
+        if self.count == 0:
+            return {'count': 0, 'KS': 0., 'PSI': 0., 'AUROC': 0.5}
+        window_le = np.cumsum(self.ks_counts)[:-1] / float(self.count)
+        ks = np.max(np.abs(window_le - self.ks_levels)) if len(self.ks_levels) else 0.
+        # proportions floored so that an empty bin does not make PSI infinite
+        actual = np.maximum(self.psi_counts / float(self.count), 1e-4)
+        expected = np.maximum(self.psi_expected, 1e-4)
+        psi = np.sum((actual - expected) * np.log(actual / expected))
+        return {'count': self.count, 'KS': float(ks), 'PSI': float(psi),
+                'AUROC': float(1. - self.cdf_sum / self.count)}
+
+    def check(self):
+        '''returns the statistics, with 'alerts' listing those over their
+           threshold, and calls on_alert for the ones that just crossed it'''
+        stats = self.statistics()
+        alerts = []
+        if self.count >= self.min_count:
+            for name, threshold in self.thresholds.items():
+                value = abs(stats[name] - 0.5) if name == 'AUROC' else stats[name]
+                if value > threshold:
+                    alerts.append(name)
+        for name in alerts:
+            if name not in self.alerting and self.on_alert is not None:
+                self.on_alert(name, stats[name])
+        self.alerting = set(alerts)
+        stats['alerts'] = alerts
+        return stats
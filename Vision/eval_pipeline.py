@@ -0,0 +1,115 @@
+# evaluation of a checkpoint over a registry of datasets
+#
+# A background thread loads each dataset and cuts it into contiguous float32
+# batches while the compiled network runs on the batches already queued, so
+# the next dataset is ready by the time the current one is finished.  Logits
+# are written into one preallocated array per dataset (and checkpoint, for
+# snapshot ensembles) and stored in the logits cache.
+
+import queue
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+import logits_cache as lc
+
+# data: an array, or a function returning one (called on the loader thread)
+# key: dataset key for the logits cache; None fingerprints the array itself,
+#      which requires data to be an array
+# in_distribution: True for the set the detector scores are measured against
+EvalSet = namedtuple('EvalSet', ['name', 'data', 'key', 'in_distribution'], defaults=(None, False))
+
+
+_DONE = object()
+
+
+def _produce(jobs, batchsize, out_queue):
+    try:
+        for name, data in jobs:
+            x = data() if callable(data) else data
+            out_queue.put((name, len(x)))
+            for start in range(0, len(x), batchsize):
+                out_queue.put(np.ascontiguousarray(x[start:start + batchsize], dtype=np.float32))
+            del x
+    except BaseException as e:
+        out_queue.put(e)
+    out_queue.put(_DONE)
+
+
+def prefetch_batches(jobs, batchsize=500, max_prefetch=8):
+    '''
+    yields (name, n) when a dataset starts, followed by its batches; loading and
+    slicing happen on a background thread that stays at most max_prefetch
+    items ahead
+    '''
+    items = queue.Queue(maxsize=max_prefetch)
+    worker = threading.Thread(target=_produce, args=(jobs, batchsize, items))
+    worker.daemon = True
+    worker.start()
+    while True:
+        item = items.get()
+        if item is _DONE:
+            break
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+    worker.join()
+
+
+def evaluate(logits_fn, checkpoint, eval_sets, batchsize=500, cache_dir='./data/logits_cache'):
+    '''
+    returns an OrderedDict name -> logits for every EvalSet in eval_sets,
+    running logits_fn only over the sets missing from the logits cache
+    '''
+    results = evaluate_ensemble(logits_fn, None, [checkpoint], eval_sets, batchsize, cache_dir)
+    return OrderedDict((name, logits[0]) for name, logits in results.items())
+
+
+def evaluate_ensemble(logits_fn, set_params, checkpoints, eval_sets, batchsize=500, cache_dir='./data/logits_cache'):
+    '''
+    returns an OrderedDict name -> [logits under each of checkpoints] for every
+    EvalSet in eval_sets
+
+    set_params(i): loads the parameters of checkpoints[i] into the network
+                   behind logits_fn (None if logits_fn already has them and
+                   there is a single checkpoint)
+
+    Every batch is loaded once and scored by each checkpoint whose logits are
+    not cached before the next batch is fetched, so an ensemble of K
+    checkpoints costs K forward passes but a single pass over the data.  The
+    checkpoints are visited in alternating order, so consecutive batches share
+    a parameter swap.
+    '''
+    hashes = [lc.file_hash(c) for c in checkpoints]
+    keys, results, jobs = {}, OrderedDict(), []
+    for s in eval_sets:
+        keys[s.name] = s.key if s.key is not None else lc.array_fingerprint(s.data)
+        results[s.name] = [lc.load_logits(h, keys[s.name], cache_dir) for h in hashes]
+        if any(logits is None for logits in results[s.name]):
+            jobs.append((s.name, s.data))
+
+    loaded = None
+    name, outs, filled, missing = None, {}, 0, []
+    for item in prefetch_batches(jobs, batchsize):
+        if isinstance(item, tuple):
+            name, n, outs, filled = item[0], item[1], {}, 0
+            missing = [i for i, logits in enumerate(results[name]) if logits is None]
+            print("Scoring {} ({} examples, {} checkpoint(s))...".format(name, n, len(missing)))
+            continue
+        if missing[-1] == loaded:
+            missing.reverse()
+        for i in missing:
+            if i != loaded and set_params is not None:
+                set_params(i)
+                loaded = i
+            logits = logits_fn(item)
+            if i not in outs:
+                outs[i] = np.empty((n,) + logits.shape[1:], dtype=logits.dtype)
+            outs[i][filled:filled + len(logits)] = logits
+        filled += len(item)
+        if filled == n:
+            for i in missing:
+                lc.store_logits(outs[i], hashes[i], keys[name], cache_dir)
+                results[name][i] = outs[i]
+    return results
@@ -0,0 +1,227 @@
+# inference-only version of a trained ResNet_FullPre_Wide
+#
+# The deterministic network is a chain of linear maps (convolutions, dense
+# layers, mean pooling, and BatchNorm, which at test time is a per-channel
+# scale and shift) broken up by nonlinearities and residual sums.  This
+# module rewrites the graph so that the per-channel affine maps disappear
+# into the weights around them:
+#
+#   * a BatchNorm after a linear convolution is folded into its weights and
+#     bias,
+#   * a scale and shift in front of a convolution or dense layer (the
+#     BatchNorm after the stem, the input normalization x / 255 - pixel_mean)
+#     is folded into that layer; near the borders the zero padding makes the
+#     folded shift position dependent, so such convolutions get an untied
+#     (per-position) bias computed here once,
+#   * a BatchNorm before a residual sum keeps only its scale, and the shifts
+#     of all branches are carried past the sum into the next linear layer.
+#
+# A pre-activation BatchNorm, one feeding a nonlinearity directly (bn_post_conv
+# in front of the final gelu), has no linear layer to go into: it is not
+# folded but stays in the graph as a ScaleLayer followed by a BiasLayer.
+#
+# The result takes the raw uint8 CIFAR images (N, 3, 32, 32) as input, so no
+# float32 copy is made before the network runs.
+#
+# Nothing uses it yet: scoring_server.py keeps running the network as trained
+# until test_inference_net.py, which compares the folded and unfolded logits,
+# has passed against a Lasagne with BatchNormLayer.
+
+import numpy as np
+import theano
+import theano.tensor as T
+import lasagne
+from lasagne.layers import (InputLayer, DenseLayer, DropoutLayer, NonlinearityLayer, ElemwiseSumLayer,
+                            GlobalPoolLayer, BatchNormLayer, ExpressionLayer, ScaleLayer, BiasLayer)
+from lasagne.layers.conv import BaseConvLayer
+
+try:
+    from lasagne.layers.dnn import BatchNormDNNLayer
+    BATCH_NORM_LAYERS = (BatchNormLayer, BatchNormDNNLayer)
+except ImportError:
+    BATCH_NORM_LAYERS = (BatchNormLayer,)
+
+
+def _value(param):
+    return None if param is None else param.get_value().astype(np.float64)
+
+
+def bn_affine(layer):
+    '''(scale, shift) such that the deterministic output of a BatchNorm layer
+       is scale * x + shift, per channel'''
+    scale = _value(layer.inv_std)
+    if layer.gamma is not None:
+        scale = scale * _value(layer.gamma)
+    shift = -_value(layer.mean) * scale
+    if layer.beta is not None:
+        shift = shift + _value(layer.beta)
+    return scale, shift
+
+
+def _pad_widths(pad, filter_size):
+    if pad == 'same':
+        return [(f // 2, (f - 1) // 2) for f in filter_size]
+    if pad == 'full':
+        return [(f - 1, f - 1) for f in filter_size]
+    return [(p, p) for p in pad]
+
+
+def conv_bias_map(shift, W, stride, pad, flip_filters=True):
+    '''
+    output of a convolution with weights W applied to the constant image
+    shift (C, H, W) with zero padding, i.e. the bias that the padding makes
+    position dependent when a shift is folded into W
+    '''
+    (top, bottom), (left, right) = _pad_widths(pad, W.shape[2:])
+    padded = np.pad(shift, ((0, 0), (top, bottom), (left, right)), mode='constant')
+    if flip_filters:
+        W = W[:, :, ::-1, ::-1]
+    fh, fw = W.shape[2:]
+    rows = (padded.shape[1] - fh) // stride[0] + 1
+    cols = (padded.shape[2] - fw) // stride[1] + 1
+    out = np.zeros((W.shape[0], rows, cols))
+    for a in range(fh):
+        for b in range(fw):
+            window = padded[:, a:a + stride[0] * (rows - 1) + 1:stride[0], b:b + stride[1] * (cols - 1) + 1:stride[1]]
+            out += np.einsum('fc,chw->fhw', W[:, :, a, b], window)
+    return out
+
+
+def _untie_if_needed(bias):
+    '''reduces an (F, H, W) bias to (F,) when it does not vary with position'''
+    if bias.ndim == 3 and np.allclose(bias, bias[:, :1, :1], rtol=1e-6, atol=1e-7):
+        return bias[:, 0, 0]
+    return bias
+
+
+def _floatX(x):
+    return np.asarray(x, dtype=theano.config.floatX)
+
+
+class _Folder(object):
+    '''
+    translates the layers of a trained network one at a time; translate
+    returns (layer, scale, shift) where the original layer's output equals
+    scale * layer's output + shift per channel (None meaning 1 and 0, and
+    shift being (C,), (C, 1, 1) or a per-position (C, H, W))
+    '''
+    def __init__(self, network, pixel_mean, input_var):
+        self.pixel_mean = np.asarray(pixel_mean, dtype=np.float64)
+        self.input_var = input_var
+        self.done = {}
+        self.consumers = {}
+        for layer in lasagne.layers.get_all_layers(network):
+            for incoming in getattr(layer, 'input_layers', [getattr(layer, 'input_layer', None)]):
+                if incoming is not None:
+                    self.consumers[incoming] = self.consumers.get(incoming, 0) + 1
+
+    def translate(self, layer):
+        if layer not in self.done:
+            self.done[layer] = self._translate(layer)
+        return self.done[layer]
+
+    def materialize(self, layer):
+        new, scale, shift = self.translate(layer)
+        if scale is not None:
+            new = ScaleLayer(new, scales=_floatX(scale))
+        if shift is not None:
+            if shift.ndim == 3 and shift.shape[1:] != (1, 1):
+                new = BiasLayer(new, b=_floatX(shift), shared_axes=(0,))
+            else:
+                new = BiasLayer(new, b=_floatX(shift.reshape(shift.shape[0])))
+        return new
+
+    def _translate(self, layer):
+        if isinstance(layer, InputLayer):
+            # the network was trained on x / 255 - pixel_mean
+            raw = InputLayer(layer.shape, input_var=self.input_var)
+            x = ExpressionLayer(raw, lambda v: T.cast(v, theano.config.floatX))
+            return x, np.full(layer.shape[1], 1. / 255), -self.pixel_mean
+        if isinstance(layer, DropoutLayer):
+            return self.translate(layer.input_layer)
+        if isinstance(layer, BATCH_NORM_LAYERS):
+            scale, shift = bn_affine(layer)
+            incoming = layer.input_layer
+            if (isinstance(incoming, BaseConvLayer) and self.consumers.get(incoming) == 1
+                    and incoming.nonlinearity in (None, lasagne.nonlinearities.identity)):
+                return self.conv(incoming, scale, shift), None, None
+            new, in_scale, in_shift = self.translate(incoming)
+            shift = shift[:, None, None]
+            if in_shift is not None:
+                shift = shift + scale[:, None, None] * in_shift
+            return new, scale if in_scale is None else scale * in_scale, shift
+        if isinstance(layer, BaseConvLayer):
+            return self.conv(layer), None, None
+        if isinstance(layer, DenseLayer):
+            new, scale, shift = self.translate(layer.input_layer)
+            W, b = _value(layer.W), _value(layer.b)
+            if b is None:
+                b = np.zeros(W.shape[1])
+            if shift is not None:
+                b = b + shift.dot(W)
+            if scale is not None:
+                W = scale[:, None] * W
+            return DenseLayer(new, num_units=layer.num_units, W=_floatX(W), b=_floatX(b),
+                              nonlinearity=layer.nonlinearity), None, None
+        if isinstance(layer, GlobalPoolLayer) and layer.pool_function is T.mean:
+            # averaging commutes with a per-channel scale
+            new, scale, shift = self.translate(layer.input_layer)
+            return GlobalPoolLayer(new, T.mean), scale, None if shift is None else shift.mean(axis=(1, 2))
+        if isinstance(layer, ElemwiseSumLayer):
+            # the branches keep their scales; their shifts add up past the sum
+            branches, total = [], None
+            for incoming, coeff in zip(layer.input_layers, layer.coeffs):
+                new, scale, shift = self.translate(incoming)
+                if scale is not None:
+                    new = ScaleLayer(new, scales=_floatX(scale))
+                if shift is not None:
+                    total = coeff * shift if total is None else total + coeff * shift
+                branches.append(new)
+            return ElemwiseSumLayer(branches, coeffs=layer.coeffs), None, total
+        if isinstance(layer, NonlinearityLayer):
+            return NonlinearityLayer(self.materialize(layer.input_layer), layer.nonlinearity), None, None
+        raise ValueError('cannot fold layer of type ' + type(layer).__name__)
+
+    def conv(self, layer, out_scale=None, out_shift=None):
+        '''the convolution with its input's affine map folded into the weights
+           and out_scale * output + out_shift folded into weights and bias'''
+        new, scale, shift = self.translate(layer.input_layer)
+        W, b = _value(layer.W), _value(layer.b)
+        bias = np.zeros(W.shape[0]) if b is None else b
+        flip = getattr(layer, 'flip_filters', True)
+        if shift is not None:
+            shift = np.broadcast_to(shift, (W.shape[1],) + tuple(layer.input_shape[2:]))
+            bias_map = conv_bias_map(shift, W, layer.stride, layer.pad, flip)
+            bias = _untie_if_needed(bias_map + (bias if bias.ndim == 3 else bias[:, None, None]))
+        if scale is not None:
+            W = W * scale[None, :, None, None]
+        if out_scale is not None:
+            W = W * out_scale[:, None, None, None]
+            bias = out_scale.reshape((-1,) + (1,) * (bias.ndim - 1)) * bias
+        if out_shift is not None:
+            bias = bias + out_shift.reshape((-1,) + (1,) * (bias.ndim - 1))
+        return type(layer)(new, num_filters=layer.num_filters, filter_size=layer.filter_size,
+                           stride=layer.stride, pad=layer.pad, untie_biases=bias.ndim == 3,
+                           W=_floatX(W), b=_floatX(bias), nonlinearity=layer.nonlinearity,
+                           flip_filters=flip)
+
+
+def fold_network(network, pixel_mean, input_var):
+    '''
+    network: the trained ResNet_FullPre_Wide output layer, parameters loaded
+    pixel_mean: (3, 32, 32) mean the network's inputs were centered with
+    input_var: uint8 tensor4 of raw images (N, 3, 32, 32)
+
+    returns the folded output layer (the softmax); its input_layer gives the
+    pre-softmax outputs
+    '''
+    return _Folder(network, pixel_mean, input_var).translate(network)[0]
+
+
+def compile_inference_fn(network, pixel_mean):
+    '''function mapping a batch of uint8 images (N, 3, 32, 32) to the
+       pre-softmax outputs of network'''
+    input_var = T.tensor4('raw_inputs', dtype='uint8')
+    folded = fold_network(network, pixel_mean, input_var)
+    logits = lasagne.layers.get_output(folded.input_layer, deterministic=True)
+    return theano.function([input_var], logits)
@@ -0,0 +1,73 @@
+# nearest-neighbour OOD scores on penultimate features
+#
+# The reference features (the pooled features of the training set) are L2
+# normalized and written to a memory-mapped .npy store, float32 or float16.
+# A query is scored by its distance to the k-th nearest reference feature:
+# queries and references are processed in blocks, each block pair being one
+# matrix product, and only the k smallest distances per query are kept
+# between reference blocks.  Larger scores are more in-distribution, as for
+# the other detectors.
+
+import os
+
+import numpy as np
+
+
+def l2_normalize(x):
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.sqrt(np.sum(x * x, axis=1, keepdims=True)), np.float32(1e-12))
+
+
+def write_store(features, fname, dtype=np.float32, chunk_rows=10000):
+    '''writes the L2 normalized rows of features to the .npy file fname'''
+    tmp = fname + '.tmp{}'.format(os.getpid())
+    out = np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype, shape=features.shape)
+    for start in range(0, len(features), chunk_rows):
+        out[start:start + chunk_rows] = l2_normalize(features[start:start + chunk_rows])
+    out.flush()
+    del out
+    os.replace(tmp, fname)
+
+
+class KNNIndex(object):
+    '''
+    features: normalized reference features (N, D), e.g. a memory-mapped store
+    block_rows: reference rows converted to float32 and multiplied at a time
+    '''
+    def __init__(self, features, block_rows=8192):
+        self.features = features
+        self.block_rows = block_rows
+        # squared norms are 1 up to the rounding of the stored dtype
+        self.sq_norms = np.empty(len(features), dtype=np.float32)
+        for start in range(0, len(features), block_rows):
+            block = np.asarray(features[start:start + block_rows], dtype=np.float32)
+            self.sq_norms[start:start + len(block)] = np.sum(block * block, axis=1)
+
+    def __len__(self):
+        return len(self.features)
+
+    def kth_distance(self, queries, k=1, batch_size=1024):
+        '''Euclidean distance from each normalized query to its k-th nearest
+           reference feature'''
+        if not 1 <= k <= len(self):
+            raise ValueError('k = {} out of range for {} reference features'.format(k, len(self)))
+        out = np.empty(len(queries), dtype=np.float32)
+        for qs in range(0, len(queries), batch_size):
+            q = l2_normalize(queries[qs:qs + batch_size])
+            # ||q - r||^2 - ||q||^2, smallest k so far
+            best = np.full((len(q), k), np.inf, dtype=np.float32)
+            for rs in range(0, len(self), self.block_rows):
+                r = np.asarray(self.features[rs:rs + self.block_rows], dtype=np.float32)
+                d = self.sq_norms[rs:rs + len(r)] - 2 * q.dot(r.T)
+                d = np.concatenate([best, d], axis=1)
+                best = np.partition(d, k - 1, axis=1)[:, :k]
+            kth = np.max(best, axis=1) + np.sum(q * q, axis=1)
+            out[qs:qs + len(q)] = np.sqrt(np.maximum(kth, 0))
+        return out
+
+    def score(self, queries, k=1, batch_size=1024):
+        return -self.kth_distance(queries, k, batch_size)
+
+
+def load_store(fname, block_rows=8192):
+    return KNNIndex(np.load(fname, mmap_mode='r'), block_rows)
@@ -1,47 +1,31 @@
 # code repurposed from the tf-learn library
-import sys
 import os
-import pickle
 import numpy as np
 from six.moves import urllib
-import tarfile
+
+import cifar_cache
 
 def to_categorical(y, nb_classes):
     y = np.asarray(y, dtype='int32')
     if not nb_classes:
         nb_classes = np.max(y)+1
     Y = np.zeros((len(y), nb_classes))
-    for i in range(len(y)):
-        Y[i, y[i]] = 1.
+    Y[np.arange(len(y)), y] = 1.
     return Y
 
+
 # load training and testing data
 def load_data100(randomize=True, return_val=False, one_hot=False,
-              label_mode='fine', dirname="cifar-100-python"):
+              label_mode='fine', uint8=False, dirname="cifar-100-python"):
     tarpath = maybe_download("cifar-100-python.tar.gz",
                              "http://www.cs.toronto.edu/~kriz/", dirname)
 
-    X_train, Y_train = load_batch(os.path.join(dirname, 'train'), label_mode=label_mode)
-
-    X_test, Y_test = load_batch(os.path.join(dirname, 'test'), label_mode=label_mode)
+    batches = cifar_cache.read_folder(dirname, tarpath, ['train', 'test'])
 
-    X_train = np.dstack((X_train[:, :1024], X_train[:, 1024:2048],
-                         X_train[:, 2048:])) / 255.
-    X_train = np.reshape(X_train, [-1, 32, 32, 3])
-    X_test = np.dstack((X_test[:, :1024], X_test[:, 1024:2048],
-                        X_test[:, 2048:])) / 255.
-    X_test = np.reshape(X_test, [-1, 32, 32, 3])
+    # with uint8 the train/val split below returns views, see cifar_cache.fill_images
+    X_test, Y_test = cifar_cache.fill_images([batches['test']], label_mode + '_labels', randomize, uint8)
+    X_train, Y_train = cifar_cache.fill_images([batches['train']], label_mode + '_labels', randomize, uint8)
 
-    if randomize is True:
-        test_perm = np.array(np.random.permutation(X_test.shape[0]))
-        X_test = X_test[test_perm]
-        Y_test = np.asarray(Y_test)
-        Y_test = Y_test[test_perm]
-
-        perm = np.array(np.random.permutation(X_train.shape[0]))
-        X_train = X_train[perm]
-        Y_train = np.asarray(Y_train)
-        Y_train = Y_train[perm]
     if return_val:
         X_train, X_val = np.split(X_train, [45000])     # 45000 for training, 5000 for validation
         Y_train, Y_val = np.split(Y_train, [45000])
@@ -60,8 +44,7 @@ def load_data100(randomize=True, return_val=False, one_hot=False,
 
 
 def load_batch(fpath, label_mode='fine'):
-    with open(fpath, 'rb') as f:
-        d = pickle.load(f, encoding='latin1')
+    d = cifar_cache.unpickle(fpath)
     data = d["data"]
     labels = d[label_mode + "_labels"]
     return data, labels
@@ -77,18 +60,9 @@ def maybe_download(filename, source_url, work_directory):
                                                  filepath)
         statinfo = os.stat(filepath)
         print(('CIFAR 100 downloaded', filename, statinfo.st_size, 'bytes.'))
-        untar(filepath)
+        # the batches are read from the archive, which need not be extracted
     return filepath
 
 
-def untar(fname):
-    if (fname.endswith("tar.gz")):
-        tar = tarfile.open(fname)
-        tar.extractall()
-        tar.close()
-        print("File Extracted in Current Directory")
-    else:
-        print("Not a tar.gz file: '%s '" % sys.argv[0])
-
 if __name__ == '__main__':
     load_data100()
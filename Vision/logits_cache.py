@@ -0,0 +1,88 @@
+# on-disk store of network outputs so that re-scoring skips the forward pass
+#
+# Logits are keyed by a hash of the checkpoint file and a fingerprint of the
+# dataset, so they are only recomputed when either of them changes:
+#   <cache_dir>/<checkpoint hash>/<dataset fingerprint>.npy
+
+import os
+import hashlib
+
+import numpy as np
+
+
+def file_hash(fname, chunk_size=1 << 24):
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def array_fingerprint(x, chunk_rows=1000):
+    '''hash of the shape, dtype and contents of x, read chunk_rows at a time
+       so that memory-mapped arrays are not pulled into memory whole'''
+    h = hashlib.sha1('{}{}'.format(x.shape, x.dtype).encode())
+    for start in range(0, len(x), chunk_rows):
+        h.update(np.ascontiguousarray(x[start:start + chunk_rows]).data)
+    return h.hexdigest()
+
+
+def combine_keys(*parts):
+    '''dataset key built from anything with a stable str(), e.g. a file hash
+       plus the preprocessing parameters'''
+    return hashlib.sha1('|'.join(str(p) for p in parts).encode()).hexdigest()
+
+
+def logits_path(checkpoint_hash, dataset_key, cache_dir='./data/logits_cache'):
+    return os.path.join(cache_dir, checkpoint_hash[:20], dataset_key[:20] + '.npy')
+
+
+def compute_logits(logits_fn, x, batchsize=500):
+    '''runs logits_fn over every example of x, the last partial batch included'''
+    out = None
+    for start in range(0, len(x), batchsize):
+        batch = logits_fn(x[start:start + batchsize])
+        if out is None:
+            out = np.empty((len(x),) + batch.shape[1:], dtype=batch.dtype)
+        out[start:start + len(batch)] = batch
+    return out
+
+
+def load_logits(checkpoint_hash, dataset_key, cache_dir='./data/logits_cache'):
+    '''returns the cached logits, or None if they have not been computed yet'''
+    fname = logits_path(checkpoint_hash, dataset_key, cache_dir)
+    if os.path.exists(fname):
+        return np.load(fname)
+    return None
+
+
+def store_logits(logits, checkpoint_hash, dataset_key, cache_dir='./data/logits_cache'):
+    fname = logits_path(checkpoint_hash, dataset_key, cache_dir)
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    # write then rename so that readers never see a partial file
+    tmp = fname + '.tmp{}'.format(os.getpid())
+    with open(tmp, 'wb') as f:
+        np.save(f, logits)
+    os.replace(tmp, fname)
+
+
+def get_logits(logits_fn, checkpoint, x, dataset_key=None, cache_dir='./data/logits_cache', batchsize=500):
+    '''
+    returns the logits of every example in x under the network stored in checkpoint
+
+    logits_fn: callable mapping a batch of inputs to logits; only called on a
+               cache miss, so it may compile the network lazily
+    x: the inputs, or a function returning them which is only called on a
+       cache miss; the latter needs an explicit dataset_key
+    dataset_key: key identifying x; by default a fingerprint of its contents
+    '''
+    if dataset_key is None:
+        dataset_key = array_fingerprint(x)
+    checkpoint_hash = file_hash(checkpoint)
+    logits = load_logits(checkpoint_hash, dataset_key, cache_dir)
+    if logits is None:
+        if callable(x):
+            x = x()
+        logits = compute_logits(logits_fn, x, batchsize)
+        store_logits(logits, checkpoint_hash, dataset_key, cache_dir)
+    return logits
@@ -0,0 +1,142 @@
+# randomly cropped and mirrored training minibatches, prepared by background
+# threads
+#
+# n_workers threads prepare the minibatches of an epoch ahead of the training
+# loop, at most queue_size each.  A worker copies the images of a minibatch
+# into the middle of its zero-padded buffer and takes every crop with a single
+# np.take into one of its preallocated output buffers; NumPy releases the GIL
+# for these copies, so they overlap with train_fn.
+#
+# With flip, an epoch draws from 2 N indices for N images, index i >= N
+# standing for image i - N mirrored, as if the mirrored copies were stored
+# after the images.  A mirrored crop reverses its row of np.take indices, so
+# no mirrored image is ever stored.
+#
+# Minibatch j is made by worker j % n_workers from that worker's own random
+# stream and the minibatches are yielded in order, so the crops are
+# reproducible for a given seed and number of workers.
+
+import queue
+import threading
+
+import numpy as np
+
+
+def crop_indices(shape, pad):
+    '''flat index, into one zero-padded (C, H + 2 pad, W + 2 pad) image, of
+       every pixel of the (C, H, W) crop at offset (0, 0)'''
+    C, H, W = shape
+    Hp, Wp = H + 2 * pad, W + 2 * pad
+    return (np.arange(C)[:, None, None] * (Hp * Wp) + np.arange(H)[:, None] * Wp + np.arange(W)).astype(np.intp)
+
+
+class _Worker(object):
+    def __init__(self, batchsize, shape, dtype, pad, n_buffers, rng):
+        C, H, W = shape
+        self.pad = pad
+        self.rng = rng
+        # only the middle is ever written, the border stays zero
+        self.padded = np.zeros((batchsize, C, H + 2 * pad, W + 2 * pad), dtype=dtype)
+        self.base = crop_indices(shape, pad)
+        self.index = np.empty((batchsize, C, H, W), dtype=np.intp)
+        self.buffers = [np.empty((batchsize, C, H, W), dtype=dtype) for _ in range(n_buffers)]
+        self.next_buffer = 0
+
+    def crop(self, inputs, rows, flipped=None):
+        '''the images inputs[rows], each cropped at a random offset of its
+           padded version and mirrored where flipped, in the next output buffer'''
+        n, p = len(rows), self.pad
+        _, _, Hp, Wp = self.padded.shape
+        self.padded[:n, :, p:Hp - p, p:Wp - p] = inputs[rows]
+        offsets = self.rng.integers(0, 2 * p + 1, size=(n, 2))
+        shift = np.arange(n) * self.padded[0].size + offsets[:, 0] * Wp + offsets[:, 1]
+        index = self.index[:n]
+        np.add(self.base, shift[:, None, None, None], out=index)
+        if flipped is not None and np.any(flipped):
+            index[flipped] = index[flipped, :, :, ::-1]
+        out = self.buffers[self.next_buffer][:n]
+        self.next_buffer = (self.next_buffer + 1) % len(self.buffers)
+        np.take(self.padded.reshape(-1), index, out=out)
+        return out
+
+
+class AugmentedBatches(object):
+    '''
+    batchsize: images per minibatch; the last incomplete minibatch is dropped
+    shape: (C, H, W) of the images
+    pad: zero padding on each side, crops are taken at offsets 0..2 pad
+    flip: an epoch also sees every image mirrored left to right
+    seed: seeds the random streams of the workers
+    '''
+    def __init__(self, batchsize, shape, dtype=np.float32, pad=4, flip=False, n_workers=2, queue_size=4, seed=0):
+        self.batchsize = batchsize
+        self.flip = flip
+        self.queue_size = queue_size
+        # a worker's buffers are in its queue, held by the consumer or being filled
+        self.workers = [_Worker(batchsize, shape, dtype, pad, queue_size + 2, np.random.default_rng(s))
+                        for s in np.random.SeedSequence(seed).spawn(n_workers)]
+
+    def get_state(self):
+        '''the states of the random streams of the workers, e.g. to resume
+           training; JSON serializable'''
+        return [w.rng.bit_generator.state for w in self.workers]
+
+    def set_state(self, states):
+        for w, state in zip(self.workers, states):
+            w.rng.bit_generator.state = state
+
+    def epoch_size(self, n):
+        '''examples seen in an epoch over n images'''
+        return 2 * n if self.flip else n
+
+    def iterate(self, inputs, targets, shuffle=False):
+        '''
+        yields (inputs, targets) minibatches of randomly cropped (and, with
+        flip, mirrored) images; the order is shuffled with np.random like
+        iterate_minibatches.  A minibatch is only valid until the next one is
+        taken.
+        '''
+        assert len(inputs) == len(targets)
+        n = len(inputs)
+        indices = np.arange(self.epoch_size(n))
+        if shuffle:
+            np.random.shuffle(indices)
+        starts = range(0, len(indices) - self.batchsize + 1, self.batchsize)
+        queues = [queue.Queue(self.queue_size) for _ in self.workers]
+        stop = threading.Event()
+
+        def put(q, item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce(w):
+            worker = self.workers[w]
+            try:
+                for j in range(w, len(starts), len(self.workers)):
+                    excerpt = indices[starts[j]:starts[j] + self.batchsize]
+                    rows = excerpt % n
+                    flipped = excerpt >= n if self.flip else None
+                    if not put(queues[w], (worker.crop(inputs, rows, flipped), targets[rows])):
+                        return
+            except Exception as e:
+                # raised again in the training loop
+                put(queues[w], e)
+
+        threads = [threading.Thread(target=produce, args=(w,), daemon=True) for w in range(len(self.workers))]
+        for t in threads:
+            t.start()
+        try:
+            for j in range(len(starts)):
+                batch = queues[j % len(queues)].get()
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+            for t in threads:
+                t.join()
@@ -0,0 +1,152 @@
+# out-of-distribution data sources that are preprocessed (or generated) one
+# chunk at a time
+#
+# A source behaves like a read-only NCHW float32 array: it has a length and a
+# shape and returns preprocessed images for a slice, so it can be passed to
+# iterate_minibatches or eval_pipeline in place of the full array.  Only the
+# requested rows are ever converted, so peak memory does not depend on the size
+# of the OOD set.
+
+import os
+
+import numpy as np
+
+
+class ImageSource(object):
+    '''
+    images: array-like of (N, 32, 32, 3) images, typically a memory-mapped .npy
+    mean: (3, 32, 32) array subtracted from every image after the conversion
+    '''
+    def __init__(self, images, mean=None):
+        self.images = images
+        self.mean = None if mean is None else np.asarray(mean, dtype=np.float32)
+        self.shape = (len(images), 3) + tuple(images.shape[1:3])
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        chunk = np.asarray(self.images[index]).transpose(0, 3, 1, 2).astype(np.float32)
+        if self.mean is not None:
+            chunk -= self.mean
+        return chunk
+
+
+def convert_mat(mat_path, npy_path, key='m', chunk_size=10000):
+    '''
+    writes the images of a .mat file, stored as a 3072 x N matrix, to an
+    (N, 32, 32, 3) .npy file in their original dtype; MATLAB v7.3 files are
+    copied chunk by chunk, older ones have to be read whole once
+    '''
+    tmp = npy_path + '.tmp{}'.format(os.getpid())
+    try:
+        import h5py
+        with h5py.File(mat_path, 'r') as f:
+            # HDF5 stores the MATLAB matrix transposed, i.e. as N x 3072
+            m = f[key]
+            out = np.lib.format.open_memmap(tmp, mode='w+', dtype=m.dtype, shape=(m.shape[0], 32, 32, 3))
+            for start in range(0, m.shape[0], chunk_size):
+                out[start:start + chunk_size] = m[start:start + chunk_size].reshape((-1, 32, 32, 3))
+    except (ImportError, OSError):
+        import scipy.io as sio
+        m = sio.loadmat(mat_path)[key]
+        out = np.lib.format.open_memmap(tmp, mode='w+', dtype=m.dtype, shape=(m.shape[1], 32, 32, 3))
+        for start in range(0, m.shape[1], chunk_size):
+            out[start:start + chunk_size] = m[:, start:start + chunk_size].T.reshape((-1, 32, 32, 3))
+        del m
+    out.flush()
+    del out
+    os.replace(tmp, npy_path)
+
+
+def mat_images(mat_path, mean=None, key='m'):
+    '''
+    returns an ImageSource over the images of mat_path (e.g. ./data/sun-train1.mat),
+    converting them to a memory-mapped .npy next to it on first use
+    '''
+    npy_path = os.path.splitext(mat_path)[0] + '.npy'
+    if not os.path.exists(npy_path):
+        print('Converting {} to {}...'.format(mat_path, npy_path))
+        convert_mat(mat_path, npy_path, key)
+    return ImageSource(np.load(npy_path, mmap_mode='r'), mean)
+
+
+class NoiseSource(object):
+    '''
+    synthetic OOD examples generated on demand
+
+    Examples are drawn in blocks of block_size; block b always comes from a
+    generator seeded with (seed, b), so a given example has the same value no
+    matter how the source is sliced into batches or split across workers.
+
+    kind: 'gaussian' (scale), 'uniform' (low, high), 'rademacher' (scale),
+          'blobs' (p, sigma, threshold) or 'low_frequency' (scale, factor)
+    n: number of examples
+    example_shape: shape of one example, e.g. (3, 32, 32); blobs and
+                   low_frequency act on the last two axes
+    '''
+    def __init__(self, kind, n, example_shape, seed=0, block_size=1000, **params):
+        if kind not in NOISE_KINDS:
+            raise ValueError('unknown noise kind: ' + str(kind))
+        self.kind, self.seed, self.block_size, self.params = kind, seed, block_size, params
+        self.shape = (n,) + tuple(example_shape)
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def block(self, b):
+        n = min(self.block_size, len(self) - b * self.block_size)
+        rng = np.random.default_rng([self.seed, b])
+        return NOISE_KINDS[self.kind](rng, (n,) + self.shape[1:], **self.params).astype(np.float32, copy=False)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            index = np.arange(start, stop, step)
+        index = np.asarray(index)
+        out = np.empty((len(index),) + self.shape[1:], dtype=np.float32)
+        blocks = index // self.block_size
+        for b in np.unique(blocks):
+            rows = blocks == b
+            out[rows] = self.block(b)[index[rows] - b * self.block_size]
+        return out
+
+    def key(self):
+        '''stable description of the generated data, for the logits cache'''
+        return 'noise-v1|{}|{}|{}|{}|{}'.format(self.kind, self.shape, self.seed, self.block_size,
+                                                 sorted(self.params.items()))
+
+
+def _gaussian(rng, shape, scale=1.):
+    return rng.normal(scale=scale, size=shape)
+
+
+def _uniform(rng, shape, low=0., high=1.):
+    return rng.uniform(low, high, size=shape)
+
+
+def _rademacher(rng, shape, scale=1.):
+    return scale * (2. * rng.integers(0, 2, size=shape) - 1.)
+
+
+def _blobs(rng, shape, p=0.7, sigma=1.5, threshold=0.75):
+    # smoothed Bernoulli noise thresholded into blobs
+    from scipy.ndimage import gaussian_filter
+    x = rng.binomial(n=1, p=p, size=shape).astype(np.float32)
+    sigmas = (0,) * (len(shape) - 2) + (sigma, sigma)
+    return (gaussian_filter(x, sigmas) > threshold).astype(np.float32)
+
+
+def _low_frequency(rng, shape, scale=1., factor=8):
+    # Gaussian noise on a grid factor times coarser, bilinearly upsampled
+    from scipy.ndimage import zoom
+    h, w = shape[-2], shape[-1]
+    coarse = rng.normal(scale=scale, size=shape[:-2] + (-(-h // factor) + 1, -(-w // factor) + 1))
+    zoomed = zoom(coarse, (1,) * (len(shape) - 2) + (factor, factor), order=1)
+    return zoomed[..., :h, :w]
+
+
+NOISE_KINDS = {'gaussian': _gaussian, 'uniform': _uniform, 'rademacher': _rademacher,
+               'blobs': _blobs, 'low_frequency': _low_frequency}
@@ -0,0 +1,151 @@
+# detection reports from stored network outputs or scores
+#
+# Only NumPy and the NumPy-only metric modules are imported here, so a report
+# can be recomputed from the logits cache, sharded_eval shards or a saved
+# score file without loading theano, lasagne or tensorflow.
+#
+# usage:
+#   python report.py logits --labels Y_test.npy --in test_logits.npy --out SUN=sun_logits.npy [--out ...]
+#   python report.py scores ctc_scores.npz
+
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+
+import detection_metrics as dm
+import detector_scores as ds
+
+# none of these may be imported, see test_report.py
+HEAVY_MODULES = ('theano', 'lasagne', 'tensorflow', 'sklearn')
+
+
+def print_logits_report(logits, labels, ood_logits, intervals=True, temperatures=np.logspace(0, 3, 50)):
+    '''
+    the CIFAR_Detection.py report: right/wrong and in/out distinction with
+    max_softmax and KL[p||u], then the best temperature of every detector
+
+    logits, labels: in-distribution test logits and labels
+    ood_logits: OrderedDict name -> logits of each OOD set
+    '''
+    r = np.argmax(logits, axis=1) == labels
+    kl_all, conf_all = ds.kl_uniform(logits), ds.max_softmax(logits)
+    kl_right, conf_right, conf_wrong = kl_all[r], conf_all[r], conf_all[np.logical_not(r)]
+
+    print('Classification Accuracy:', len(conf_right)/(len(conf_right) + len(conf_wrong)))
+    print('Prediction confidence (mean, std):', np.mean(conf_all), np.std(conf_all))
+    print('Prediction confidence right (mean, std):', np.mean(conf_right), np.std(conf_right))
+    print('Prediction confidence wrong (mean, std):', np.mean(conf_wrong), np.std(conf_wrong))
+
+    # the in-distribution scores are sorted once and reused for every comparison below
+    kl_right, conf_right = dm.sort_scores(kl_right), dm.sort_scores(conf_right)
+
+    print('\nPrediction Confidence: Right/Wrong classification distinction')
+    dm.print_measures(dm.get_measures(conf_right, conf_wrong))
+    if intervals:
+        dm.print_intervals(conf_right, conf_wrong)
+
+    # OOD detection
+
+    bad_examples = []
+
+    for name, oos_logits in ood_logits.items():
+        kl_oos, conf_oos = ds.kl_uniform(oos_logits), ds.max_softmax(oos_logits)
+        bad_examples.append(conf_oos)
+
+        print('\nPrediction confidence {} (mean, std):'.format(name), np.mean(conf_oos), np.std(conf_oos))
+
+        print('\nKL[p||u]: In/out distribution distinction (from {}; relative to right)'.format(name))
+        dm.print_measures(dm.get_measures(kl_right, kl_oos))
+
+        print('\nPrediction Confidence: In/out distribution distinction (from {}; relative to right)'.format(name))
+        dm.print_measures(dm.get_measures(conf_right, conf_oos))
+        if intervals:
+            dm.print_intervals(conf_right, conf_oos)
+
+    if not bad_examples:
+        return
+
+    print('\n\nPrediction Confidence: In/out distribution distinction (from ALL; relative to right)')
+    oos = np.concatenate(bad_examples)
+    print('In sample examples (right):', len(conf_right), 'OOD examples:', len(oos))
+    dm.print_measures(dm.get_measures(conf_right, oos))
+    if intervals:
+        dm.print_intervals(conf_right, oos)
+
+    # other detectors and a temperature sweep, all from the same logits
+    in_scores = ds.all_scores(logits[r], temperatures)
+    out_scores = ds.all_scores(np.concatenate(list(ood_logits.values())), temperatures)
+    measures = {name: dm.get_measures(dm.sort_scores(in_scores[name]), out_scores[name]) for name in in_scores}
+
+    print('\n\nDetector sweep: In/out distribution distinction (from ALL; relative to right)')
+    for family in ('max_logit', 'margin') + ds.TEMPERATURE_FAMILIES:
+        names = [name for name in measures if name.split(' ')[0] == family]
+        best = max(names, key=lambda name: measures[name]['AUROC'])
+        print('{:<24} AUROC {:.4f}  AUPR (Succ) {:.4f}  AUPR (Err) {:.4f}  FPR {:.4f}'.format(
+            best, measures[best]['AUROC'], measures[best]['AUPR (Succ)'], measures[best]['AUPR (Err)'], measures[best]['FPR']))
+
+
+def save_scores(fname, in_scores, ood_scores):
+    '''
+    in_scores: dict detector -> in-distribution scores
+    ood_scores: dict OOD set -> dict detector -> scores
+    '''
+    arrays = OrderedDict(('in/' + d, np.asarray(s)) for d, s in in_scores.items())
+    for name, scores in ood_scores.items():
+        for d, s in scores.items():
+            arrays['out/{}/{}'.format(name, d)] = np.asarray(s)
+    np.savez(fname, **arrays)
+
+
+def load_scores(fname):
+    '''returns (in_scores, ood_scores) as written by save_scores'''
+    in_scores, ood_scores = OrderedDict(), OrderedDict()
+    with np.load(fname) as f:
+        for key in f.files:
+            if key.startswith('in/'):
+                in_scores[key[3:]] = f[key]
+            else:
+                name, d = key[4:].rsplit('/', 1)
+                ood_scores.setdefault(name, OrderedDict())[d] = f[key]
+    return in_scores, ood_scores
+
+
+def print_scores_report(in_scores, ood_scores):
+    '''in/out distinction of every detector against every OOD set and all of them'''
+    in_sorted = {d: dm.sort_scores(s) for d, s in in_scores.items()}
+    for name, scores in ood_scores.items():
+        for d, s in scores.items():
+            print('\n{} {}: In/out distribution distinction'.format(name, d))
+            dm.print_measures(dm.get_measures(in_sorted[d], s))
+    if len(ood_scores) > 1:
+        for d in in_sorted:
+            print('\nALL {}: In/out distribution distinction'.format(d))
+            dm.print_measures(dm.get_measures(in_sorted[d], np.concatenate([s[d] for s in ood_scores.values()])))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('logits', help='report from stored in-distribution and OOD logits')
+    p.add_argument('--labels', required=True, help='.npy of the in-distribution labels')
+    p.add_argument('--in', dest='in_logits', required=True, help='.npy of the in-distribution logits')
+    p.add_argument('--out', action='append', default=[], metavar='NAME=FILE', help='.npy of OOD logits; may be repeated')
+    p.add_argument('--no-intervals', action='store_true', help='skip the confidence intervals')
+    p = sub.add_parser('scores', help='report from a score file written by save_scores')
+    p.add_argument('fname')
+    args = parser.parse_args(argv)
+
+    if args.command == 'logits':
+        ood_logits = OrderedDict()
+        for spec in args.out:
+            name, fname = spec.split('=', 1) if '=' in spec else (spec, spec)
+            ood_logits[name] = np.load(fname, mmap_mode='r')
+        print_logits_report(np.load(args.in_logits, mmap_mode='r'), np.load(args.labels), ood_logits,
+                            intervals=not args.no_intervals)
+    else:
+        print_scores_report(*load_scores(args.fname))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+# long-running local scoring server for the ResNet_FullPre_Wide detector
+#
+# The checkpoint is loaded and the inference function compiled once.  Request
+# threads hand single images to a MicroBatcher, whose worker thread runs the
+# network on everything that arrived within max_latency of the first waiting
+# image (at most max_batch images), so concurrent requests share forward passes.
+#
+# POST /score with the 3072 raw bytes of one CIFAR image (the R, G and B planes,
+# as in the dataset pickles) returns
+#   {"class": ..., "max_softmax": ..., "kl_uniform": ...}
+#
+# With --reference (a max_softmax ThresholdIndex written by CIFAR_Detection.py,
+# or a .npy of reference scores) the max_softmax scores served are also fed to
+# a DriftMonitor: alerts are printed, and GET /drift returns its statistics.
+#
+# usage: python scoring_server.py --model ./data/network_3_1_49.npz [--port 8000 | --socket /tmp/score.sock]
+
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+import socketserver
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import cifar_cache
+import detector_scores as ds
+import drift_monitor
+import threshold_index as ti
+
+
+class MicroBatcher(object):
+    '''
+    batch_fn: maps a stacked batch of inputs to a list with one result per input
+    max_batch: largest batch handed to batch_fn
+    max_latency: seconds the first waiting input waits for others to join it
+    '''
+    def __init__(self, batch_fn, max_batch=256, max_latency=0.005):
+        self.batch_fn = batch_fn
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.pending = queue.Queue()
+        worker = threading.Thread(target=self._run)
+        worker.daemon = True
+        worker.start()
+
+    def submit(self, x):
+        '''returns a Future for the result of x'''
+        future = Future()
+        self.pending.put((x, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.time() + self.max_latency
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.time()
+                try:
+                    batch.append(self.pending.get(timeout=timeout) if timeout > 0 else self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                results = self.batch_fn(np.stack([x for x, _ in batch]))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+def make_score_fn(logits_fn, pixel_mean, monitor=None, lock=None):
+    '''
+    maps a batch of raw uint8 CIFAR rows to one result dict per image
+
+    pixel_mean: the images are converted to float32 and centered with it
+                before logits_fn sees them
+    monitor: optional DriftMonitor fed with the max_softmax scores, under lock
+    '''
+    def score(rows):
+        x = rows.reshape((-1, 3, 32, 32)).astype(np.float32)
+        x /= np.float32(255)
+        x -= pixel_mean
+        logits = logits_fn(x)
+        pred = np.argmax(logits, axis=1)
+        conf, kl = ds.max_softmax(logits), ds.kl_uniform(logits)
+        if monitor is not None:
+            with lock:
+                monitor.add(conf)
+        return [{'class': int(c), 'max_softmax': float(p), 'kl_uniform': float(d)}
+                for c, p, d in zip(pred, conf, kl)]
+    return score
+
+
+def make_handler(batcher, monitor=None, lock=None):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/drift' or monitor is None:
+                self.send_error(404)
+                return
+            with lock:
+                monitor.expire(time.time())
+                stats = monitor.check()
+            self.reply(stats)
+
+        def do_POST(self):
+            if self.path != '/score':
+                self.send_error(404)
+                return
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if len(body) != 3072:
+                self.send_error(400, 'expected the 3072 bytes of one 32x32 RGB image')
+                return
+            try:
+                result = batcher.submit(np.frombuffer(body, dtype=np.uint8)).result()
+            except Exception as e:
+                self.send_error(500, str(e))
+                return
+            self.reply(result)
+
+        def reply(self, result):
+            reply = json.dumps(result).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(reply)))
+            self.end_headers()
+            self.wfile.write(reply)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+# bursts of concurrent clients are what the micro-batching is for, so allow a
+# long accept backlog
+class ScoringHTTPServer(ThreadingHTTPServer):
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class ScoringUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', required=True, help='.npz checkpoint written by SGDR_WRNs_gelu.py')
+    parser.add_argument('--dataset', default='CIFAR-10')
+    parser.add_argument('--n', type=int, default=6)
+    parser.add_argument('--k', type=int, default=4)
+    parser.add_argument('--cache-dir', default='./data/cifar_cache', help='cifar_cache directory holding pixel_mean')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--socket', help='listen on this Unix socket instead of a TCP port')
+    parser.add_argument('--max-batch', type=int, default=256)
+    parser.add_argument('--max-latency-ms', type=float, default=5.)
+    parser.add_argument('--reference', help='max_softmax ThresholdIndex (.npz) or reference scores (.npy) for drift monitoring')
+    parser.add_argument('--drift-window', type=float, default=3600., help='drift monitor window in seconds')
+    args = parser.parse_args()
+
+    import theano.tensor as T
+    from CIFAR_Detection import ResNet_FullPre_Wide, compile_logits_fn
+
+    nout = 100 if args.dataset == 'CIFAR-100' else 10
+    pixel_mean = np.load(os.path.join(cifar_cache.cache_path(args.dataset, args.cache_dir), 'pixel_mean.npy'))
+
+    print("Building model and compiling functions...")
+    input_var = T.tensor4('inputs')
+    network = ResNet_FullPre_Wide(input_var, nout, args.n, args.k)
+    logits_fn = compile_logits_fn(network, input_var, args.model)
+
+    monitor, lock = None, threading.Lock()
+    if args.reference:
+        if args.reference.endswith('.npz'):
+            values, levels = drift_monitor.index_cdf(ti.load_index(args.reference))
+        else:
+            values, levels = drift_monitor.reference_cdf(np.load(args.reference))
+        def on_alert(name, value):
+            print('{} drift alert: {} = {:.4f}'.format(time.strftime('%Y-%m-%d %H:%M:%S'), name, value))
+        monitor = drift_monitor.DriftMonitor(values, levels, window=args.drift_window, on_alert=on_alert)
+
+    batcher = MicroBatcher(make_score_fn(logits_fn, pixel_mean, monitor, lock), args.max_batch, args.max_latency_ms / 1000.)
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = ScoringUnixHTTPServer(args.socket, make_handler(batcher, monitor, lock))
+        print('Listening on', args.socket)
+    else:
+        server = ScoringHTTPServer(('127.0.0.1', args.port), make_handler(batcher, monitor, lock))
+        print('Listening on port', args.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    sys.setrecursionlimit(10000)
+    main()
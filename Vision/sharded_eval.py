@@ -0,0 +1,248 @@
+# sharded, resumable evaluation of one checkpoint over an in-distribution set
+# and any number of OOD sets
+#
+# plan cuts every set into index shards and queues one task file per shard in
+# <workdir>/todo.  Any number of workers, local or on other nodes sharing
+# workdir, claim tasks by renaming them into <workdir>/claimed (a rename
+# succeeds for exactly one of them), write the logits of the shard to
+# <workdir>/shards with a write-then-rename, and drop the claim.  Re-running
+# plan (once no worker is running) queues again whatever has no shard file,
+# so an interrupted run resumes where it stopped.  merge concatenates the
+# shards and prints the detection measures.
+#
+# usage:
+#   python sharded_eval.py plan  --workdir ./data/run1 --model ./data/network_3_1_49.npz \
+#                                --ood ./data/sun-train1.mat --ood noise:gaussian
+#   OMP_NUM_THREADS=1 python sharded_eval.py work --workdir ./data/run1 --workers 8
+#   python sharded_eval.py merge --workdir ./data/run1
+#
+# Set specs: 'test' (the CIFAR test set), 'noise:<kind>' (an ood_sources
+# NoiseSource of the size of the test set), or a .mat / .npy file of
+# (N, 32, 32, 3) images, centered with the training pixel mean.
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import multiprocessing
+from collections import OrderedDict
+
+import numpy as np
+
+import cifar_cache
+import ood_sources as ood
+import report
+
+# parameters of the generated sets, as in CIFAR_Detection.py
+NOISE_PARAMS = {'gaussian': {'scale': 0.5}}
+
+
+def open_set(spec, data):
+    '''the examples described by spec; data is the cifar_cache dict'''
+    if spec == 'test':
+        return data['X_test']
+    if spec.startswith('noise:'):
+        kind = spec.split(':', 1)[1]
+        return ood.NoiseSource(kind, len(data['X_test']), data['X_test'].shape[1:], seed=0,
+                               **NOISE_PARAMS.get(kind, {}))
+    if spec.endswith('.mat'):
+        return ood.mat_images(spec, mean=data['pixel_mean'])
+    if spec.endswith('.npy'):
+        return ood.ImageSource(np.load(spec, mmap_mode='r'), mean=data['pixel_mean'])
+    raise ValueError('unknown set: ' + spec)
+
+
+def shard_name(set_index, start, stop):
+    return '{:03d}_{:09d}_{:09d}'.format(set_index, start, stop)
+
+
+def parse_shard_name(name):
+    set_index, start, stop = name.split('.')[0].split('_')
+    return int(set_index), int(start), int(stop)
+
+
+def _dirs(workdir):
+    return [os.path.join(workdir, d) for d in ('todo', 'claimed', 'shards')]
+
+
+def load_config(workdir):
+    with open(os.path.join(workdir, 'config.json')) as f:
+        return json.load(f)
+
+
+def plan(args):
+    '''writes the configuration and queues every shard without a shard file'''
+    todo, claimed, shards = _dirs(args.workdir)
+    for d in (todo, claimed, shards):
+        os.makedirs(d, exist_ok=True)
+    config_file = os.path.join(args.workdir, 'config.json')
+    if os.path.exists(config_file):
+        config = load_config(args.workdir)
+        print('Resuming the run configured in', config_file)
+    else:
+        data = cifar_cache.load_cached(args.dataset, args.data_dir)
+        specs = ['test'] + args.ood
+        config = {'model': os.path.abspath(args.model), 'dataset': args.dataset,
+                  'data_dir': os.path.abspath(args.data_dir), 'n': args.n, 'k': args.k,
+                  'batchsize': args.batchsize, 'shard_size': args.shard_size,
+                  'sets': [{'spec': spec, 'n': len(open_set(spec, data))} for spec in specs]}
+        tmp = config_file + '.tmp{}'.format(os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(config, f, indent=1)
+        os.replace(tmp, config_file)
+
+    # a claim left behind by a dead worker is queued again as well
+    queued = 0
+    for i, s in enumerate(config['sets']):
+        for start in range(0, s['n'], config['shard_size']):
+            name = shard_name(i, start, min(start + config['shard_size'], s['n']))
+            if os.path.exists(os.path.join(shards, name + '.npy')):
+                continue
+            for c in os.listdir(claimed):
+                if c.startswith(name):
+                    try:
+                        os.rename(os.path.join(claimed, c), os.path.join(todo, name))
+                    except OSError:
+                        pass
+            if not os.path.exists(os.path.join(todo, name)):
+                open(os.path.join(todo, name), 'w').close()
+            queued += 1
+    print('{} shard(s) queued in {}'.format(queued, todo))
+
+
+def claim(todo, claimed):
+    '''moves one queued task to claimed and returns its new path, or None once
+       the queue is empty'''
+    owner = '{}.{}'.format(socket.gethostname(), os.getpid())
+    while True:
+        names = sorted(os.listdir(todo))
+        if not names:
+            return None
+        for name in names:
+            path = os.path.join(claimed, name + '.' + owner)
+            try:
+                os.rename(os.path.join(todo, name), path)
+                return path
+            except OSError:
+                # taken by another worker in the meantime
+                continue
+
+
+def work_loop(workdir):
+    '''processes shards until the queue is empty'''
+    config = load_config(workdir)
+    todo, claimed, shards = _dirs(workdir)
+
+    import theano.tensor as T
+    from CIFAR_Detection import ResNet_FullPre_Wide, compile_logits_fn
+
+    data = cifar_cache.load_cached(config['dataset'], config['data_dir'])
+    nout = 100 if config['dataset'] == 'CIFAR-100' else 10
+    sets, logits_fn = {}, None
+    done = 0
+    while True:
+        task = claim(todo, claimed)
+        if task is None:
+            break
+        set_index, start, stop = parse_shard_name(os.path.basename(task))
+        if logits_fn is None:
+            input_var = T.tensor4('inputs')
+            network = ResNet_FullPre_Wide(input_var, nout, config['n'], config['k'])
+            logits_fn = compile_logits_fn(network, input_var, config['model'])
+        if set_index not in sets:
+            sets[set_index] = open_set(config['sets'][set_index]['spec'], data)
+        x = sets[set_index]
+        out = np.concatenate([logits_fn(np.ascontiguousarray(x[i:min(i + config['batchsize'], stop)], dtype=np.float32))
+                              for i in range(start, stop, config['batchsize'])])
+        fname = os.path.join(shards, shard_name(set_index, start, stop) + '.npy')
+        tmp = fname + '.tmp{}'.format(os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, out)
+        os.replace(tmp, fname)
+        try:
+            os.remove(task)
+        except OSError:
+            # plan queued the shard again while it was being processed
+            pass
+        done += 1
+    print('Worker {} finished after {} shard(s)'.format(os.getpid(), done))
+
+
+def work(args):
+    if args.workers == 1:
+        work_loop(args.workdir)
+        return
+    workers = [multiprocessing.Process(target=work_loop, args=(args.workdir,)) for _ in range(args.workers)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+
+def merge_logits(workdir, config):
+    '''returns [logits of each set], or None after listing the missing shards'''
+    shards = _dirs(workdir)[2]
+    out, missing = [], []
+    for i, s in enumerate(config['sets']):
+        parts = []
+        for start in range(0, s['n'], config['shard_size']):
+            fname = os.path.join(shards, shard_name(i, start, min(start + config['shard_size'], s['n'])) + '.npy')
+            if os.path.exists(fname):
+                parts.append(np.load(fname))
+            else:
+                missing.append(os.path.basename(fname))
+        out.append(np.concatenate(parts) if parts else None)
+    if missing:
+        print('{} shard(s) missing, e.g. {}; run plan and work again'.format(len(missing), missing[0]))
+        return None
+    return out
+
+
+def merge(args):
+    config = load_config(args.workdir)
+    all_logits = merge_logits(args.workdir, config)
+    if all_logits is None:
+        sys.exit(1)
+    Y_test = cifar_cache.load_cached(config['dataset'], config['data_dir'])['Y_test']
+    report.print_logits_report(all_logits[0], Y_test,
+                               OrderedDict((s['spec'], logits) for s, logits in zip(config['sets'][1:], all_logits[1:])))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('plan', help='configure a run and queue its shards')
+    p.add_argument('--workdir', required=True)
+    p.add_argument('--model', help='.npz checkpoint written by SGDR_WRNs_gelu.py')
+    p.add_argument('--dataset', default='CIFAR-10')
+    p.add_argument('--data-dir', default='.', help='directory holding the CIFAR pickles')
+    p.add_argument('--ood', action='append', default=[], help='OOD set spec; may be repeated')
+    p.add_argument('--n', type=int, default=6)
+    p.add_argument('--k', type=int, default=4)
+    p.add_argument('--shard-size', type=int, default=2000)
+    p.add_argument('--batchsize', type=int, default=500)
+    p.set_defaults(run=plan)
+
+    p = sub.add_parser('work', help='process queued shards')
+    p.add_argument('--workdir', required=True)
+    p.add_argument('--workers', type=int, default=1, help='local worker processes')
+    p.set_defaults(run=work)
+
+    p = sub.add_parser('merge', help='combine the shards and report the measures')
+    p.add_argument('--workdir', required=True)
+    p.set_defaults(run=merge)
+
+    args = parser.parse_args()
+    if args.command == 'plan' and args.model is None and not os.path.exists(os.path.join(args.workdir, 'config.json')):
+        parser.error('plan needs --model for a new run')
+    start = time.time()
+    args.run(args)
+    print('Done in {:.1f}s'.format(time.time() - start))
+
+
+if __name__ == '__main__':
+    sys.setrecursionlimit(10000)
+    main()
@@ -0,0 +1,112 @@
+# detection measures for score streams of unbounded length
+#
+# The in-distribution and out-of-distribution scores are counted in two
+# histograms with fixed, equal-width bins over [low, high] (scores outside the
+# range go to the end bins).  Memory is 2 * n_bins counters whatever the
+# length of the stream, histograms from parallel workers merge by addition,
+# and the measures are those of detection_metrics with every bin treated as
+# one tied score value.
+#
+# Error bound: binning only loses the order of scores that share a bin, so
+#   |AUROC - exact AUROC| <= 0.5 * sum_b in_b * out_b / (n_in * n_out)
+# where in_b, out_b are the counts of bin b, and the exact average precisions
+# lie between the values obtained by putting the positives of every bin first
+# or last within it.  intervals() computes these bounds from the counts; for
+# scores with densities bounded by f the AUROC bound is at most
+# 0.5 * f * (high - low) / n_bins.  FPR and detection error are resolved to
+# one bin.
+
+import numpy as np
+
+import detection_metrics as dm
+
+
+class StreamingMeasures(object):
+    def __init__(self, low=0., high=1., n_bins=10000):
+        self.low, self.high, self.n_bins = float(low), float(high), int(n_bins)
+        self.in_counts = np.zeros(self.n_bins, dtype=np.int64)
+        self.out_counts = np.zeros(self.n_bins, dtype=np.int64)
+
+    def bins(self, scores):
+        '''bin index of each score'''
+        scaled = (np.asarray(scores, dtype=np.float64).ravel() - self.low) * (self.n_bins / (self.high - self.low))
+        return np.clip(scaled, 0, self.n_bins - 1).astype(np.int64)
+
+    def add(self, scores, in_distribution, weight=1):
+        '''counts a batch of scores; weight=-1 removes scores added before,
+           e.g. when they leave a sliding window'''
+        counts = self.in_counts if in_distribution else self.out_counts
+        counts += weight * np.bincount(self.bins(scores), minlength=self.n_bins)
+
+    def merge(self, other):
+        '''adds the counts of a StreamingMeasures with the same bins'''
+        if (other.low, other.high, other.n_bins) != (self.low, self.high, self.n_bins):
+            raise ValueError('can only merge histograms with the same bins')
+        self.in_counts += other.in_counts
+        self.out_counts += other.out_counts
+        return self
+
+    @property
+    def n_in(self):
+        return int(np.sum(self.in_counts))
+
+    @property
+    def n_out(self):
+        return int(np.sum(self.out_counts))
+
+    def _occupied(self):
+        keep = (self.in_counts + self.out_counts) > 0
+        return self.in_counts[keep], self.out_counts[keep]
+
+    def measures(self, recall_level=0.95):
+        '''the measures of detection_metrics.get_measures over the histograms'''
+        n_in, n_out = self.n_in, self.n_out
+        if n_in == 0 or n_out == 0:
+            raise ValueError('need at least one in-distribution and one out-of-distribution score')
+        in_eq, out_eq = self._occupied()
+        return dm._measures(np.cumsum(in_eq), np.cumsum(out_eq), n_in, n_out, recall_level)
+
+    def intervals(self):
+        '''
+        dict measure -> (lower, upper) guaranteed to contain the exact AUROC,
+        AUPR (Succ) and AUPR (Err) of the scores counted
+        '''
+        from scipy.special import digamma
+
+        n_in, n_out = self.n_in, self.n_out
+        if n_in == 0 or n_out == 0:
+            raise ValueError('need at least one in-distribution and one out-of-distribution score')
+        in_eq, out_eq = (c.astype(np.float64) for c in self._occupied())
+
+        auroc = self.measures()['AUROC']
+        slack = 0.5 * np.sum(in_eq * out_eq) / (float(n_in) * n_out)
+
+        def ap_bounds(pos, neg, n_pos):
+            # pos, neg: counts per bin in the order the threshold sweeps them.
+            # With a positives and b negatives ranked above a bin holding p
+            # positives and m negatives, the precisions of its positives sum
+            # to sum_j (a + j) / (a + b + j) = p - b (psi(a + b + p + 1) - psi(a + b + 1))
+            # when they come first in the bin, and to the same with b + m in
+            # place of b when they come last.
+            a = np.cumsum(pos) - pos
+            b = np.cumsum(neg) - neg
+            upper = pos - b * (digamma(a + b + pos + 1) - digamma(a + b + 1))
+            lower = pos - (b + neg) * (digamma(a + b + neg + pos + 1) - digamma(a + b + neg + 1))
+            return float(np.sum(lower) / n_pos), float(np.sum(upper) / n_pos)
+
+        # in-distribution positives are swept from the highest score down,
+        # out-of-distribution positives from the lowest score up
+        return {'AUROC': (float(auroc - slack), float(auroc + slack)),
+                'AUPR (Succ)': ap_bounds(in_eq[::-1], out_eq[::-1], n_in),
+                'AUPR (Err)': ap_bounds(out_eq, in_eq, n_out)}
+
+    def save(self, fname):
+        np.savez(fname, low=self.low, high=self.high, in_counts=self.in_counts, out_counts=self.out_counts)
+
+
+def load(fname):
+    with np.load(fname) as f:
+        sm = StreamingMeasures(f['low'], f['high'], len(f['in_counts']))
+        sm.in_counts[:] = f['in_counts']
+        sm.out_counts[:] = f['out_counts']
+    return sm
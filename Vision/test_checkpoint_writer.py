@@ -0,0 +1,16 @@
+import checkpoint_writer as cw
+
+
+def records(epochs):
+    return [{'fname': './data/network_3_1_{}.npz'.format(e), 'epoch': e, 'score': None} for e in epochs]
+
+
+def test_retained_keeps_everything_by_default():
+    r = records(range(50))
+    assert cw.retained(r) == set(x['fname'] for x in r)
+
+
+def test_retained_never_prunes_keep_patterns():
+    r = records(range(50))
+    keep = cw.retained(r, keep_last=2, keep_patterns=['./data/network_3_1_4[0-9].npz'])
+    assert keep == set('./data/network_3_1_{}.npz'.format(e) for e in range(40, 50))
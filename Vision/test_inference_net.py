@@ -0,0 +1,36 @@
+# the folded inference network must compute what the trained network computes
+# deterministically; needs theano and a lasagne with BatchNormLayer
+
+import numpy as np
+import pytest
+
+theano = pytest.importorskip('theano')
+lasagne = pytest.importorskip('lasagne')
+if not hasattr(lasagne.layers, 'BatchNormLayer'):
+    pytest.skip('lasagne without BatchNormLayer', allow_module_level=True)
+
+import theano.tensor as T
+from CIFAR_Detection import ResNet_FullPre_Wide, compile_logits_fn
+import inference_net
+
+
+def test_folded_matches_unfolded():
+    rng = np.random.RandomState(0)
+    floatX = theano.config.floatX
+    input_var = T.tensor4('inputs')
+    network = ResNet_FullPre_Wide(input_var, nout=10, n=1, k=1)
+    # trained statistics are far from the initial mean 0, inv_std 1
+    for layer in lasagne.layers.get_all_layers(network):
+        if isinstance(layer, inference_net.BATCH_NORM_LAYERS):
+            C = layer.mean.get_value().shape[0]
+            layer.mean.set_value(rng.uniform(-0.5, 0.5, C).astype(floatX))
+            layer.inv_std.set_value(rng.uniform(0.5, 2, C).astype(floatX))
+            layer.beta.set_value(rng.uniform(-0.5, 0.5, C).astype(floatX))
+            layer.gamma.set_value(rng.uniform(0.5, 1.5, C).astype(floatX))
+    pixel_mean = rng.uniform(0.3, 0.7, (3, 32, 32)).astype(np.float32)
+    images = rng.randint(0, 256, (8, 3, 32, 32)).astype(np.uint8)
+
+    unfolded = compile_logits_fn(network, input_var)(np.divide(images, np.float32(255), dtype=np.float32) - pixel_mean)
+    folded = inference_net.compile_inference_fn(network, pixel_mean)(images)
+    assert folded.shape == unfolded.shape
+    assert np.allclose(folded, unfolded, rtol=1e-4, atol=1e-4 * np.abs(unfolded).max())
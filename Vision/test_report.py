@@ -0,0 +1,33 @@
+# report.py must stay usable without the deep learning frameworks: run it in a
+# fresh interpreter on a tiny score file and check what it imported
+
+import os
+import sys
+import json
+import subprocess
+
+import numpy as np
+
+VISION = os.path.dirname(os.path.abspath(__file__))
+
+SCRIPT = '''
+import sys, json
+from collections import OrderedDict
+import numpy as np
+import report
+f = np.load(sys.argv[1])
+report.print_logits_report(f['logits'], f['labels'], OrderedDict(noise=f['ood_logits']), intervals=False)
+print(json.dumps(sorted(m for m in report.HEAVY_MODULES if m in sys.modules)))
+'''
+
+
+def test_report_imports_no_framework(tmp_path):
+    rng = np.random.RandomState(0)
+    fname = str(tmp_path / 'logits.npz')
+    np.savez(fname, logits=rng.randn(200, 10) * 3, labels=rng.randint(0, 10, 200),
+             ood_logits=rng.randn(100, 10))
+    out = subprocess.run([sys.executable, '-c', SCRIPT, fname], cwd=VISION, check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True).stdout
+    loaded = json.loads(out.strip().splitlines()[-1])
+    assert 'AUROC' in out
+    assert loaded == []
@@ -0,0 +1,16 @@
+import training_stats as ts
+
+
+def test_keep_first_lines(tmp_path):
+    fname = str(tmp_path / 'stat.txt')
+    with open(fname, 'w') as f:
+        f.write('0\ta\n1\tb\n2\tc\n3\t')
+    ts.keep_first_lines(fname, 2)
+    assert open(fname).read() == '0\ta\n1\tb\n'
+    # fewer lines than asked for: only the cut-off one goes
+    with open(fname, 'a') as f:
+        f.write('2\t')
+    ts.keep_first_lines(fname, 5)
+    assert open(fname).read() == '0\ta\n1\tb\n'
+    ts.keep_first_lines(str(tmp_path / 'missing.txt'), 3)
+    assert not (tmp_path / 'missing.txt').exists()
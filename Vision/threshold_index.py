@@ -0,0 +1,80 @@
+# compact quantile index of in-distribution detector scores
+#
+# The index keeps the sorted in-distribution scores at a fixed set of levels
+# (all of them if there are few), so an online scorer can turn a score into
+# the fraction of in-distribution examples scoring at most as high, or a
+# target TPR into a threshold, with one binary search and without the
+# validation scores themselves.  Flagging "score < threshold" as abnormal,
+# that fraction is the in-distribution false-positive rate of the threshold.
+#
+# usage: python threshold_index.py scores.npy index.npz [n_points]
+
+import sys
+
+import numpy as np
+
+
+class ThresholdIndex(object):
+    '''
+    quantiles: ascending distinct in-distribution scores
+    levels: fraction of in-distribution scores <= each quantile
+    exact: True if quantiles holds every distinct in-distribution score
+    '''
+    def __init__(self, quantiles, levels, n, exact, score_name='', checkpoint=''):
+        self.quantiles = np.asarray(quantiles)
+        self.levels = np.asarray(levels, dtype=np.float64)
+        self.n = int(n)
+        self.exact = bool(exact)
+        self.score_name = str(score_name)
+        self.checkpoint = str(checkpoint)
+
+    def percentile(self, scores):
+        '''fraction of in-distribution scores <= scores; exact at the stored
+           quantiles and a lower bound in between'''
+        i = np.searchsorted(self.quantiles, scores, 'right') - 1
+        return np.where(i >= 0, self.levels[np.maximum(i, 0)], 0.)
+
+    def fpr(self, scores):
+        '''in-distribution false-positive rate when flagging everything below
+           each score'''
+        i = np.searchsorted(self.quantiles, scores, 'left') - 1
+        return np.where(i >= 0, self.levels[np.maximum(i, 0)], 0.)
+
+    def threshold(self, tpr):
+        '''largest stored threshold that keeps at least tpr of the
+           in-distribution scores (score >= threshold)'''
+        k = np.searchsorted(self.levels, 1. - np.asarray(tpr), 'right')
+        if self.exact:
+            # fewer than 1 - tpr of the scores lie below the next stored score
+            return np.where(k < len(self.quantiles), self.quantiles[np.minimum(k, len(self.quantiles) - 1)], np.inf)
+        # between stored scores only the previous one is known to be safe
+        return np.where(k > 0, self.quantiles[np.maximum(k - 1, 0)], -np.inf)
+
+    def save(self, fname):
+        np.savez(fname, quantiles=self.quantiles, levels=self.levels, n=self.n, exact=self.exact,
+                 score_name=self.score_name, checkpoint=self.checkpoint)
+
+
+def build_index(scores, n_points=10001, score_name='', checkpoint=''):
+    '''keeps the in-distribution scores at n_points evenly spaced ranks
+       (levels are then accurate to 1 / (n_points - 1))'''
+    scores = np.sort(np.asarray(scores).ravel())
+    n = len(scores)
+    if n == 0:
+        raise ValueError('need at least one in-distribution score')
+    ranks = np.unique(np.round(np.linspace(0, n - 1, min(n, n_points))).astype(np.int64))
+    quantiles = np.unique(scores[ranks])
+    levels = np.searchsorted(scores, quantiles, 'right') / float(n)
+    return ThresholdIndex(quantiles, levels, n, n <= n_points, score_name, checkpoint)
+
+
+def load_index(fname):
+    with np.load(fname) as f:
+        return ThresholdIndex(f['quantiles'], f['levels'], f['n'], f['exact'], f['score_name'], f['checkpoint'])
+
+
+if __name__ == '__main__':
+    n_points = int(sys.argv[3]) if len(sys.argv) > 3 else 10001
+    index = build_index(np.load(sys.argv[1]), n_points)
+    index.save(sys.argv[2])
+    print('Index of {} scores with {} quantiles written to {}'.format(index.n, len(index.quantiles), sys.argv[2]))
@@ -0,0 +1,133 @@
+# per-epoch performance records for the training loops
+#
+# StageTimer adds up the wall time of named stages (waiting for minibatches,
+# train_fn, validation, checkpointing); StatsLog appends one JSON object per
+# epoch to a .jsonl file; StackSampler is an optional sampling profiler that
+# counts where the training thread is every interval seconds, from a
+# background thread, so that the code profiled runs unchanged.
+# keep_first_lines rolls a log back to the epochs a resumed run starts from.
+
+import os
+import sys
+import json
+import time
+import threading
+from collections import Counter
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss_mb():
+    '''peak resident set size of this process in MB, or None where unknown'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024. * 1024.) if sys.platform == 'darwin' else peak / 1024.
+
+
+class StageTimer(object):
+    def __init__(self):
+        self.totals = Counter()
+
+    def reset(self):
+        '''returns the totals so far and starts again from zero'''
+        totals, self.totals = self.totals, Counter()
+        return totals
+
+    def __call__(self, stage):
+        '''context manager adding the time spent in it to stage'''
+        return _Stage(self, stage)
+
+    def iterate(self, iterable, stage):
+        '''yields from iterable, adding the time spent waiting for each item to stage'''
+        it = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                self.totals[stage] += time.time() - start
+            yield item
+
+
+class _Stage(object):
+    def __init__(self, timer, stage):
+        self.timer, self.stage = timer, stage
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc):
+        self.timer.totals[self.stage] += time.time() - self.start
+
+
+def keep_first_lines(fname, n):
+    '''
+    truncates fname after its first n complete lines, e.g. to drop the
+    records of epochs that a resumed run does again; a missing file is left
+    missing
+    '''
+    if not os.path.exists(fname):
+        return
+    with open(fname, 'rb+') as f:
+        end = 0
+        for _ in range(n):
+            line = f.readline()
+            if not line.endswith(b'\n'):
+                # a line cut short by the interruption
+                break
+            end += len(line)
+        f.truncate(end)
+
+
+class StatsLog(object):
+    '''appends a JSON object per line to fname, flushed after every record'''
+    def __init__(self, fname, append=False):
+        self.file = open(fname, 'a' if append else 'w')
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class StackSampler(object):
+    '''
+    samples the innermost frame of a thread (by default the one creating the
+    sampler) every interval seconds between start and stop
+
+    Any object with the same start() and stop(top) methods can be passed to
+    the training loop as its profiler instead.
+    '''
+    def __init__(self, interval=0.01, thread_id=None):
+        self.interval = interval
+        self.thread_id = threading.get_ident() if thread_id is None else thread_id
+        self.thread = None
+
+    def start(self):
+        self.counts = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self, top=20):
+        '''returns [location, fraction of the samples] of the top locations'''
+        self.stopped.set()
+        self.thread.join()
+        n = float(sum(self.counts.values())) or 1.
+        return [[location, count / n] for location, count in self.counts.most_common(top)]
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                code = frame.f_code
+                self.counts['{}:{} {}'.format(os.path.basename(code.co_filename), frame.f_lineno, code.co_name)] += 1